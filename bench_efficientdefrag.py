@@ -0,0 +1,184 @@
+#!/usr/bin/python2
+
+"""Benchmarks for efficientdefrag.py.
+Run from a CLI to either:
+Time whole defrag cycles against synthetic pools served by fake_htcondor (cycle)
+Time the slot to preemptable job match with a list of GlobalJobIds (as used
+previously) against the PreemptableJobs index (match)"""
+
+import argparse
+import logging
+import multiprocessing
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+import fake_htcondor
+sys.modules['htcondor'] = fake_htcondor
+
+import efficientdefrag
+
+
+class CountingPopen(object):
+    """ Stands in for subprocess.Popen, counting spawns instead of running condor commands"""
+    spawns = 0
+    returncode = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingPopen.spawns += 1
+
+    def communicate(self):
+        return '', ''
+
+
+def current_rss_kb():
+    """ Returns the resident set size of this process in KB"""
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() / 1024
+
+
+class RssSampler(object):
+    """ Samples the resident set size on a thread of its own while a cycle runs.
+    ru_maxrss is the peak of the whole process, so it says nothing about cycles after the first"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.peak_kb = 0
+
+    def sample(self):
+        while not self.stopped.is_set():
+            self.peak_kb = max(self.peak_kb, current_rss_kb())
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.peak_kb = current_rss_kb()
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.peak_kb = max(self.peak_kb, current_rss_kb())
+
+
+def run_cycles(args, nodes, results):
+    """ Builds a pool of nodes and runs args.cycles defrag cycles against it, putting a row of results on results"""
+    fake_htcondor.LATENCY['collector'] = args.collector_latency
+    fake_htcondor.LATENCY['schedd'] = args.schedd_latency
+    fake_htcondor.use_pool(fake_htcondor.SyntheticPool(nodes, args.preemptable_fraction, schedds=args.schedds,
+                                                       update_interval=args.update_interval))
+
+    subprocess.Popen = CountingPopen
+    efficientdefrag.probe_reachability = lambda hostnames: dict((hostname, True) for hostname in hostnames)
+    efficientdefrag.VACATE['timeout'] = args.vacate_timeout
+    efficientdefrag.VACATE['poll_interval'] = args.vacate_timeout
+
+    pool = efficientdefrag.PoolModel(fake_htcondor.Collector('localhost'), args.full_refresh_cycles)
+    for cycle in range(args.cycles):
+        if cycle:
+            fake_htcondor.POOL.touch(args.churn)
+            fake_htcondor.POOL.heartbeat(args.interval)
+        fake_htcondor.reset_stats()
+        CountingPopen.spawns = 0
+        rss_before = current_rss_kb()
+
+        start = time.time()
+        with RssSampler() as sampler:
+            efficientdefrag.run_cycle(pool)
+        wall_time = time.time() - start
+
+        peak_kb = sampler.peak_kb
+        stats = fake_htcondor.STATS
+        results.put((nodes, cycle, wall_time, stats['collector_queries'] + stats['collector_locates'],
+                     stats['schedd_queries'] + stats['schedd_acts'], stats['ads_returned'],
+                     CountingPopen.spawns, max(peak_kb - rss_before, 0) / 1024.0))
+
+
+def bench_cycle(args):
+    """ Times defrag cycles for each pool size, each size in a fresh process so one does not inherit the memory of another"""
+    print '%-8s %-6s %10s %10s %10s %10s %8s %10s' % ('nodes', 'cycle', 'wall (s)', 'collector', 'schedd', 'ads', 'spawns', 'peak (MB)')
+    for nodes in args.nodes:
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_cycles, args=(args, nodes, results))
+        process.start()
+        for _ in range(args.cycles):
+            print '%-8i %-6i %10.3f %10i %10i %10i %8i %10.1f' % results.get()
+        process.join()
+
+
+def make_global_ids(count, schedds=12):
+    """ Returns count GlobalJobIds spread over a number of schedds"""
+    return ['arc-ce%02i.gridpp.rl.ac.uk#%i.0#1500000000' % (i % schedds, i) for i in range(count)]
+
+
+def bench_preemptable_match(num_preemptable, num_slots, sample):
+    """ Times matching num_slots running jobs against num_preemptable preemptable jobs"""
+    preemptable_ids = make_global_ids(num_preemptable)
+    running_ids = make_global_ids(num_slots)
+    random.shuffle(running_ids)
+
+    jobs_list = list(preemptable_ids)
+    preemptable_jobs = efficientdefrag.PreemptableJobs()
+    for global_id in preemptable_ids:
+        preemptable_jobs.add(global_id, global_id.split('#')[0], 0)
+
+    # the list scan is far too slow to run for every slot, so time a sample and scale up
+    sampled_ids = running_ids[:sample]
+    list_time = timeit.timeit(lambda: [global_id in jobs_list for global_id in sampled_ids], number=1)
+    list_time *= float(num_slots) / len(sampled_ids)
+
+    index_time = timeit.timeit(lambda: [global_id in preemptable_jobs for global_id in running_ids], number=1)
+
+    print '%-10i %-10i %12.4f %12.4f %10.0fx' % (num_preemptable, num_slots, list_time, index_time, list_time / index_time)
+
+
+def bench_match(args):
+    """ Times the preemptable job match at a few pool sizes"""
+    print '%-10s %-10s %12s %12s %11s' % ('preempt', 'slots', 'list (s)', 'index (s)', 'speedup')
+    for num_preemptable, num_slots in [(1000, 10000), (10000, 50000), (30000, 100000)]:
+        bench_preemptable_match(num_preemptable, num_slots, args.sample)
+
+
+def main():
+    """ Main function, called when module is run as a CLI application """
+    parser = argparse.ArgumentParser(description='Benchmark efficientdefrag.py')
+    subparsers = parser.add_subparsers()
+
+    cycle_parser = subparsers.add_parser('cycle', help='time whole defrag cycles against synthetic pools')
+    cycle_parser.add_argument('--nodes', type=int, nargs='+', default=[100, 1000, 5000, 20000], help='pool sizes to run')
+    cycle_parser.add_argument('--preemptable-fraction', type=float, default=0.3, help='fraction of single core jobs that are preemptable')
+    cycle_parser.add_argument('--schedds', type=int, default=12, help='number of schedds')
+    cycle_parser.add_argument('--collector-latency', type=float, default=0.0, help='seconds added to each collector round trip')
+    cycle_parser.add_argument('--schedd-latency', type=float, default=0.0, help='seconds added to each schedd round trip')
+    cycle_parser.add_argument('--vacate-timeout', type=float, default=0.0, help='seconds killed jobs are given to vacate')
+    cycle_parser.add_argument('--cycles', type=int, default=1, help='cycles to run against each pool, as in daemon mode')
+    cycle_parser.add_argument('--full-refresh-cycles', type=int, default=efficientdefrag.DAEMON['full_refresh_cycles'],
+                              help='re-read the whole pool every this many cycles')
+    cycle_parser.add_argument('--churn', type=float, default=0.1, help='fraction of machines that change between cycles')
+    cycle_parser.add_argument('--interval', type=int, default=efficientdefrag.DAEMON['interval'],
+                              help='seconds between cycles, for the startds that send their periodic update in between')
+    cycle_parser.add_argument('--update-interval', type=int, default=300,
+                              help="seconds between each startd's periodic update to the collector")
+    cycle_parser.set_defaults(function=bench_cycle)
+
+    match_parser = subparsers.add_parser('match', help='time the preemptable job match')
+    match_parser.add_argument('--sample', type=int, default=500, help='number of slots to time the list scan with')
+    match_parser.set_defaults(function=bench_match)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s')
+    logging.getLogger('condor_efficient_defrag').setLevel(logging.ERROR)
+
+    args.function(args)
+
+
+if __name__ == "__main__":
+    main()
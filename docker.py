@@ -1,89 +1,386 @@
 #!/usr/bin/env python3
 
+import fcntl
+import hashlib
+import http.client
+import json
 import os
 import re
+import signal
+import stat
 import sys
+import tempfile
+import time
+from base64 import b64decode, b64encode
 from subprocess import Popen, PIPE
-from socket import getfqdn
-
-def gateway():
-    gateway_needed = False
-    for prefix in ['atl', 'cms', 'lhcb']:
-        gateway_needed = gateway_needed or any(prefix in arg for arg in sys.argv)
-    return gateway_needed and not os.path.isfile('/etc/nogateway')
-
-def get_primary_ipv6():
-    # Get the default route interface
-    route_info = Popen(['ip', '-6', 'route', 'show', 'default'], stdout=PIPE, stderr=PIPE)
-    stdout, _ = route_info.communicate()
-    route_output = stdout.decode().split()
-
-    # Ensure there is enough data to extract the interface
-    if len(route_output) < 5:
+import socket
+from socket import AF_INET6, gethostname, getfqdn, inet_ntop
+from urllib.parse import quote, urlencode
+
+# Per user directory for files cached between invocations of the wrapper.
+# Cached files are only used while it, and each directory in it, is owned by us with mode 0700.
+CACHE_DIR = os.environ.get('DOCKER_WRAPPER_CACHE_DIR', '/var/tmp/docker-wrapper-%d' % os.getuid())
+
+# The FQDN is only looked up again when the host's name, default interface or address changes, or it gets this old
+HOST_IDENTITY = {
+    'filename': os.path.join(CACHE_DIR, 'host-identity.json'),
+    'max_age': 3600,
+}
+
+# Talk to dockerd directly for the commands the API backend understands, instead of through sudo and the CLI.
+# The user running the wrapper needs access to the socket, otherwise the CLI is used.
+DOCKER_API = {
+    'enabled': bool(os.environ.get('DOCKER_WRAPPER_API')),
+    'socket': os.environ.get('DOCKER_WRAPPER_SOCKET', '/var/run/docker.sock'),
+    'timeout': 300,
+}
+
+# What args_create() adds for each VO. A site can override it with a JSON file of the same shape.
+DEFAULT_POLICY = {
+    # VOs are recognised by these strings anywhere in the arguments; the first match with a ulimit sets it
+    'vos': [
+        {'match': 'lhcb', 'ulimit': 'nofile=1048575:1048575', 'gateway': True},
+        {'match': 'atl', 'gateway': True},
+        {'match': 'cms', 'gateway': True},
+    ],
+    'default_ulimit': 'nofile=2097152:2097152',
+    'gateway': {
+        'label': 'xrootd-local-gateway',
+        'disable_file': '/etc/nogateway',
+        # each name list is added for the IPv4 gateway address, and for the node's IPv6 address with the suffix
+        'hosts': [
+            {'names': 'xrootd.echo.stfc.ac.uk ceph-gw10.gridpp.rl.ac.uk ceph-gw11.gridpp.rl.ac.uk ceph-svc06.gridpp.rl.ac.uk ceph-svc20.gridpp.rl.ac.uk',
+             'ipv4': '172.28.1.1', 'ipv6_suffix': ':1000:2'},
+            {'names': 'xrootd-gateway.echo.stfc.ac.uk', 'ipv4': '172.28.1.2', 'ipv6_suffix': ':1000:3'},
+        ],
+        # set to the node's FQDN, with the Apptainer and Singularity equivalents
+        'fqdn_env': ['XrdSecGSISRVNAMES', 'APPTAINERENV_XrdSecGSISRVNAMES', 'SINGULARITYENV_XrdSecGSISRVNAMES'],
+        'env': [
+            # ATLAS fix for 21.0.XX release errors with frontier
+            'FRONTIER_LOG_FILE=frontier.log',
+            # Increase timeout to prevent vector read errors
+            'XRD_STREAMTIMEOUT=300',
+            'APPTAINERENV_XRD_STREAMTIMEOUT=300',
+            'SINGULARITYENV_XRD_STREAMTIMEOUT=300',
+        ],
+    },
+    'memory': {'multiplier': 3, 'swap_multiplier': 3},
+    'nice': 10,
+}
+
+POLICY = {
+    'filename': os.environ.get('DOCKER_WRAPPER_POLICY', os.path.join(os.path.dirname(os.path.realpath(__file__)), 'docker_policy.json')),
+    'compiled': os.path.join(CACHE_DIR, 'policy.json'),
+    # change when the compiled table changes shape
+    'format': 2,
+}
+
+# Results of read only commands HTCondor polls for every container are shared for a few seconds.
+# Commands that create, remove or change the state of containers make them stale.
+COMMAND_CACHE = {
+    'dir': os.path.join(CACHE_DIR, 'commands'),
+    'generation': os.path.join(CACHE_DIR, 'commands', 'generation.json'),
+    'ttl': {
+        'inspect': 2,
+        'stats': 5,
+    },
+    'invalidate': ['create', 'run', 'rm', 'kill', 'start', 'stop', 'restart', 'pause', 'unpause', 'update', 'rename'],
+    # Of those, the ones that can last as long as the container (docker start -a, docker run) are exec'd,
+    # so no python process is left behind for each job. What was cached while they ran expires with its ttl.
+    'attached': ['start', 'run'],
+    # seconds before unused entries are removed
+    'expire': 3600,
+}
+
+# docker create options the API backend can turn into a request: option -> (kind, field)
+# Anything else makes the wrapper fall back to the CLI.
+CREATE_OPTIONS = {
+    '--name': ('name', None),
+    '--env': ('env', ('Env',)),
+    '--label': ('map', ('Labels',)),
+    '--hostname': ('string', ('Hostname',)),
+    '--user': ('string', ('User',)),
+    '--workdir': ('string', ('WorkingDir',)),
+    '--entrypoint': ('list', ('Entrypoint',)),
+    '--volume': ('volume', None),
+    '--ulimit': ('ulimit', ('HostConfig', 'Ulimits')),
+    '--add-host': ('append', ('HostConfig', 'ExtraHosts')),
+    '--memory': ('bytes', ('HostConfig', 'Memory')),
+    '--memory-swap': ('bytes', ('HostConfig', 'MemorySwap')),
+    '--memory-reservation': ('bytes', ('HostConfig', 'MemoryReservation')),
+    '--shm-size': ('bytes', ('HostConfig', 'ShmSize')),
+    '--cpu-shares': ('int', ('HostConfig', 'CpuShares')),
+    '--pids-limit': ('int', ('HostConfig', 'PidsLimit')),
+    '--network': ('string', ('HostConfig', 'NetworkMode')),
+    '--group-add': ('append', ('HostConfig', 'GroupAdd')),
+    '--cap-add': ('append', ('HostConfig', 'CapAdd')),
+    '--cap-drop': ('append', ('HostConfig', 'CapDrop')),
+    '--security-opt': ('append', ('HostConfig', 'SecurityOpt')),
+    '--rm': ('bool', ('HostConfig', 'AutoRemove')),
+    '--init': ('bool', ('HostConfig', 'Init')),
+}
+
+CREATE_ALIASES = {
+    '-e': '--env',
+    '-l': '--label',
+    '-h': '--hostname',
+    '-u': '--user',
+    '-w': '--workdir',
+    '-v': '--volume',
+    '-m': '--memory',
+    '-c': '--cpu-shares',
+    '--net': '--network',
+}
+
+RM_ALIASES = {
+    '-f': '--force',
+    '-v': '--volumes',
+}
+
+IPV6_ROUTE = '/proc/net/ipv6_route'
+IF_INET6 = '/proc/net/if_inet6'
+
+# Route and address flags from linux/ipv6_route.h and linux/if_addr.h
+RTF_REJECT = 0x0200
+IFA_F_TEMPORARY = 0x01
+IFA_F_DADFAILED = 0x08
+IFA_F_DEPRECATED = 0x20
+IFA_F_TENTATIVE = 0x40
+
+def compile_policy(policy):
+    """
+    Precompute everything args_create() needs from a policy, as plain data that can be cached as JSON
+    """
+    gateway = policy['gateway']
+    return {
+        'vos': [[vo['match'], vo.get('ulimit'), vo.get('gateway', False)] for vo in policy['vos']],
+        'default_ulimit': '--ulimit=%s' % policy['default_ulimit'],
+        'gateway_disable_file': gateway['disable_file'],
+        'gateway_on': '--label=%s=true' % gateway['label'],
+        'gateway_off': '--label=%s=false' % gateway['label'],
+        'gateway_ipv4': ['--add-host=%s:%s' % (host['names'], host['ipv4']) for host in gateway['hosts']],
+        'gateway_ipv6': [['--add-host=%s:' % host['names'], host['ipv6_suffix']] for host in gateway['hosts']],
+        'gateway_fqdn_env': ['--env=%s=' % name for name in gateway['fqdn_env']],
+        'gateway_env': ['--env=%s' % env for env in gateway['env']],
+        'memory_re': r'--memory=([\d]+)m',
+        'memory_multiplier': policy['memory']['multiplier'],
+        'swap_multiplier': policy['memory']['swap_multiplier'],
+        'nice': ['nice', '-n %d' % policy['nice']],
+    }
+
+def load_policy():
+    """
+    The compiled policy, from the cache if the policy file hasn't changed since it was compiled
+    """
+    try:
+        st = os.stat(POLICY['filename'])
+        source = [POLICY['format'], POLICY['filename'], st.st_mtime_ns, st.st_size]
+    except OSError:
+        st = None
+        # the defaults change with the wrapper, so a table compiled by an older version isn't used
+        source = [POLICY['format'], None, hashlib.sha1(json.dumps(DEFAULT_POLICY, sort_keys=True).encode()).hexdigest()]
+
+    cached = read_cache_file(POLICY['compiled'])
+    if isinstance(cached, dict) and cached.get('source') == source:
+        return cached['table']
+
+    policy = DEFAULT_POLICY
+    if st:
+        with open(POLICY['filename']) as f:
+            policy = json.load(f)
+    table = compile_policy(policy)
+    write_cache_file(POLICY['compiled'], {'source': source, 'table': table})
+    return table
+
+def read_proc(filename):
+    try:
+        with open(filename) as f:
+            return f.read()
+    except OSError:
+        return ''
+
+def get_default_interface():
+    """
+    The interface of the IPv6 default route with the lowest metric,
+    read from the kernel's routing table rather than forking ip
+    """
+    best = None
+    for line in read_proc(IPV6_ROUTE).splitlines():
+        # destination, prefix length, source, prefix length, next hop, metric, refs, use, flags, interface
+        fields = line.split()
+        if len(fields) < 10 or fields[1] != '00' or int(fields[0], 16) != 0:
+            continue
+        if int(fields[8], 16) & RTF_REJECT:
+            continue
+        metric = int(fields[5], 16)
+        if best is None or metric < best[0]:
+            best = (metric, fields[9])
+    return best[1] if best else None
+
+def get_primary_ipv6(interface=None):
+    """
+    The global IPv6 address of the default interface, preferring
+    addresses that are not temporary, deprecated or tentative
+    """
+    if interface is None:
+        interface = get_default_interface()
+    if interface is None:
         return None
 
-    default_interface = route_output[4]
+    addresses = []
+    for line in read_proc(IF_INET6).splitlines():
+        # address, interface index, prefix length, scope, flags, interface
+        fields = line.split()
+        if len(fields) < 6 or fields[5] != interface or int(fields[3], 16) != 0:
+            continue
+        flags = int(fields[4], 16)
+        if flags & IFA_F_DADFAILED:
+            continue
+        preferred = not flags & (IFA_F_TEMPORARY | IFA_F_DEPRECATED | IFA_F_TENTATIVE)
+        addresses.append((not preferred, inet_ntop(AF_INET6, bytes.fromhex(fields[0]))))
 
-    # Get IPv6 addresses for the default interface
-    addr_info = Popen(['ip', '-6', 'addr', 'show', 'dev', default_interface], stdout=PIPE, stderr=PIPE)
-    stdout, _ = addr_info.communicate()
-    addr_lines = stdout.decode().split('\n')
+    if not addresses:
+        return None
+    return sorted(addresses, key=lambda address: address[0])[0][1]
 
-    # Filter out the primary IPv6 address
-    for line in addr_lines:
-        if 'inet6' in line and 'global' in line:
-            return line.split()[1].split('/')[0]
-    return None
+def get_host_identity():
+    """
+    The default interface, primary IPv6 address and FQDN of this host.
+    The FQDN needs a resolver lookup, so it is cached in a file and only
+    looked up again when the rest of the identity changes or the cache expires
+    """
+    interface = get_default_interface()
+    identity = {
+        'interface': interface,
+        'ipv6': get_primary_ipv6(interface),
+        'hostname': gethostname(),
+    }
+    fingerprint = hashlib.sha1(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+    cached = read_cache_file(HOST_IDENTITY['filename'])
+    try:
+        if cached['fingerprint'] == fingerprint and time.time() - cached['time'] < HOST_IDENTITY['max_age']:
+            return cached['identity']
+    except (KeyError, TypeError):
+        pass
+
+    identity['fqdn'] = getfqdn()
+    write_cache_file(HOST_IDENTITY['filename'], {'fingerprint': fingerprint, 'time': time.time(), 'identity': identity})
+    return identity
+
+private_dirs = set()
+
+def private_dir(directory):
+    """
+    Create directory in CACHE_DIR if it is missing, and check nobody else can change
+    what is in it: it and the directories above it up to CACHE_DIR are real directories,
+    not symlinks, owned by us with mode 0700. Returns False if it can't be used.
+    """
+    if directory in private_dirs:
+        return True
+    if directory != CACHE_DIR and not (directory.startswith(CACHE_DIR + os.sep) and private_dir(os.path.dirname(directory))):
+        return False
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    except OSError:
+        return False
+    try:
+        st = os.lstat(directory)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+        return False
+    private_dirs.add(directory)
+    return True
+
+def open_private(filename, flags, mode='r'):
+    """
+    Open a file in a private_dir() without following a symlink
+    """
+    if not private_dir(os.path.dirname(filename)):
+        raise PermissionError('%s is not a private directory' % os.path.dirname(filename))
+    return os.fdopen(os.open(filename, flags | os.O_NOFOLLOW, 0o600), mode)
+
+def read_cache_file(filename):
+    """
+    The JSON data cached in filename, or None if it is missing,
+    unreadable or was not written by this user
+    """
+    try:
+        with open_private(filename, os.O_RDONLY) as f:
+            if os.fstat(f.fileno()).st_uid != os.getuid():
+                return None
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_cache_file(filename, data):
+    """
+    Replace filename atomically with data as JSON, so concurrent
+    invocations never read a partial file. The cache is best effort.
+    """
+    try:
+        if not private_dir(os.path.dirname(filename)):
+            return
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(filename))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(temporary, filename)
+    except OSError:
+        pass
 
 def args_create(argv):
     """
     Build the new list of command line arguments for command
         docker create
     """
-    dargs = []
+    policy = load_policy()
+    vos = policy['vos']
+    memory_re = re.compile(policy['memory_re'])
 
-    if any('lhcb' in arg for arg in sys.argv):
-        dargs.append('--ulimit=nofile=1048575:1048575')
-    else:
-        dargs.append('--ulimit=nofile=2097152:2097152')
-
-    if gateway():
-        dargs.append('--label=xrootd-local-gateway=true')
-        dargs.append('--add-host=xrootd.echo.stfc.ac.uk ceph-gw10.gridpp.rl.ac.uk ceph-gw11.gridpp.rl.ac.uk ceph-svc06.gridpp.rl.ac.uk ceph-svc20.gridpp.rl.ac.uk:172.28.1.1')
-        dargs.append('--add-host=xrootd-gateway.echo.stfc.ac.uk:172.28.1.2')
-        # Call function to capture primary IPv6 address and assign xrootd alias to local containers IPv6 address.
-        primary_ipv6 = get_primary_ipv6()
-        if primary_ipv6:
-            primary_ipv6 = primary_ipv6.rstrip(':')
-            dargs.append('--add-host=xrootd.echo.stfc.ac.uk ceph-gw10.gridpp.rl.ac.uk ceph-gw11.gridpp.rl.ac.uk ceph-svc06.gridpp.rl.ac.uk ceph-svc20.gridpp.rl.ac.uk:{}{}'.format(primary_ipv6, ':1000:2'))
-            dargs.append('--add-host=xrootd-gateway.echo.stfc.ac.uk:{}{}'.format(primary_ipv6, ':1000:3'))
-        dargs.append('--env=XrdSecGSISRVNAMES=%s' % getfqdn())
-        dargs.append('--env=APPTAINERENV_XrdSecGSISRVNAMES=%s' % getfqdn())
-        # Singularity equivalent for backwards compatibility
-        dargs.append('--env=SINGULARITYENV_XrdSecGSISRVNAMES=%s' % getfqdn())
-        # ATLAS fix for 21.0.XX release errors with frontier
-        dargs.append('--env=FRONTIER_LOG_FILE=frontier.log')
-        #Increase timeout to prevent vector read errors
-        dargs.append('--env=XRD_STREAMTIMEOUT=300')
-        dargs.append('--env=APPTAINERENV_XRD_STREAMTIMEOUT=300')
-        dargs.append('--env=SINGULARITYENV_XRD_STREAMTIMEOUT=300')
-    else:
-        dargs.append('--label=xrootd-local-gateway=false')
+    # VOs are matched against the whole command line
+    matched = set(match for match, _, _ in vos if any(match in arg for arg in sys.argv[:len(sys.argv) - len(argv)]))
 
-    # memory setup
+    # one pass to rewrite the memory setup and find the VOs in the arguments
+    args = []
     for arg in argv:
-        m = re.search(r'--memory=([\d]+)m', arg)
+        for match, _, _ in vos:
+            if match in arg:
+                matched.add(match)
+        m = '--memory=' in arg and memory_re.search(arg)
         if m:
             memory = int(m.group(1))
-            dargs.append('--memory=%dm' % (memory*3))
-            dargs.append('--memory-swap=%dm' % (memory*3))
-            dargs.append('--memory-reservation=%dm' % memory)
+            args.append('--memory=%dm' % (memory * policy['memory_multiplier']))
+            args.append('--memory-swap=%dm' % (memory * policy['swap_multiplier']))
+            args.append('--memory-reservation=%dm' % memory)
         else:
-            dargs.append(arg)
+            args.append(arg)
+
+    ulimit = next((ulimit for match, ulimit, _ in vos if ulimit and match in matched), None)
+    dargs = ['--ulimit=%s' % ulimit if ulimit else policy['default_ulimit']]
+
+    gateway = any(gateway for match, _, gateway in vos if match in matched)
+    if gateway and not os.path.isfile(policy['gateway_disable_file']):
+        dargs.append(policy['gateway_on'])
+        dargs.extend(policy['gateway_ipv4'])
+        # Capture primary IPv6 address and assign xrootd alias to local containers IPv6 address.
+        identity = get_host_identity()
+        primary_ipv6 = identity['ipv6']
+        if primary_ipv6:
+            primary_ipv6 = primary_ipv6.rstrip(':')
+            dargs.extend('%s%s%s' % (host, primary_ipv6, suffix) for host, suffix in policy['gateway_ipv6'])
+        dargs.extend(env + identity['fqdn'] for env in policy['gateway_fqdn_env'])
+        dargs.extend(policy['gateway_env'])
+    else:
+        dargs.append(policy['gateway_off'])
+
+    dargs.extend(args)
 
     if '/' in dargs[-1] and not dargs[-1].startswith('-'):
         command = dargs.pop()
-        dargs = dargs + ['nice', '-n 10', command]
+        dargs = dargs + policy['nice'] + [command]
 
     return dargs
 
@@ -102,28 +399,441 @@ def args_other_commands(argv):
     return argv
 
 def execute(args):
+    """
+    Replace this process with the command. Its output goes straight to
+    the file descriptors we inherited, and HTCondor sees its own exit code
+    or signal, with no python process left waiting on it.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execv(args[0], args)
+
+def wait_execute(args):
+    """
+    Run the command with the file descriptors we inherited and wait for it,
+    passing on the signals HTCondor sends us. Returns its return code.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    process = Popen(args, close_fds=False)
+
+    def forward(signum, frame):
+        try:
+            process.send_signal(signum)
+        except OSError:
+            pass
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT, signal.SIGUSR1, signal.SIGUSR2):
+        signal.signal(signum, forward)
+    return process.wait()
+
+def exit_as(rc):
+    """
+    Exit with the command's exit code, or die of the signal that killed it, as if it had been exec'd
+    """
+    if rc < 0:
+        signal.signal(-rc, signal.SIG_DFL)
+        os.kill(os.getpid(), -rc)
+    sys.exit(rc & 0xff)
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    An HTTP connection to dockerd's unix socket
+    """
+    def __init__(self, socket_path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        # set first, so close() closes it even if it can't connect
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+class DockerAPI(object):
+    """
+    Makes Engine API requests over one connection, reused for every request
+    """
+    def __init__(self, socket_path, timeout):
+        self.connection = UnixHTTPConnection(socket_path, timeout)
+
+    def connect(self):
+        self.connection.connect()
+
+    def close(self):
+        self.connection.close()
+
+    def request(self, method, path, body=None):
+        headers = {}
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        return response.status, response.read()
+
+def error_message(data):
+    try:
+        return json.loads(data.decode())['message']
+    except (ValueError, KeyError, TypeError):
+        return data.decode(errors='replace').strip()
+
+def to_bytes(size):
+    """
+    Convert a size like 2000m to bytes, with binary units as the docker CLI does
+    """
+    m = re.match(r'^(\d+(?:\.\d+)?) ?([kmgtp])?i?b?$', size.lower())
+    if not m:
+        raise ValueError('invalid size: %s' % size)
+    return int(float(m.group(1)) * 1024 ** ' kmgtp'.index(m.group(2) or ' '))
+
+def split_options(argv, flags, aliases):
+    """
+    Split argv into options and the arguments after them. Options are returned as
+    (name, value) with aliases resolved; flags are options that take no value.
+    """
+    options = []
+    i = 0
+    while i < len(argv) and argv[i].startswith('-') and argv[i] != '-':
+        name, _, value = argv[i].partition('=')
+        name = aliases.get(name, name)
+        if not argv[i].count('=') and name not in flags:
+            i += 1
+            if i == len(argv):
+                raise ValueError('option %s needs a value' % name)
+            value = argv[i]
+        options.append((name, value))
+        i += 1
+    return options, argv[i:]
+
+def api_create_request(argv):
+    """
+    Turn docker create arguments into the container name and Engine API request
+    body the CLI would send. Returns None if there is anything we don't handle.
+    """
+    flags = set(name for name, (kind, _) in CREATE_OPTIONS.items() if kind == 'bool')
+    try:
+        options, positional = split_options(argv, flags, CREATE_ALIASES)
+    except ValueError:
+        return None
+    if not positional:
+        return None
+
+    name = None
+    body = {
+        'Image': positional[0],
+        'AttachStdout': True,
+        'AttachStderr': True,
+        'HostConfig': {'NetworkMode': 'default'},
+    }
+    if len(positional) > 1:
+        body['Cmd'] = positional[1:]
+
+    for option, value in options:
+        if option not in CREATE_OPTIONS:
+            return None
+        kind, field = CREATE_OPTIONS[option]
+        target = body
+        if field:
+            for key in field[:-1]:
+                target = target.setdefault(key, {})
+            field = field[-1]
+        try:
+            if kind == 'name':
+                name = value
+            elif kind == 'string':
+                target[field] = value
+            elif kind == 'list':
+                target[field] = [value]
+            elif kind == 'append':
+                target.setdefault(field, []).append(value)
+            elif kind == 'env':
+                # a variable without a value is taken from our environment, and dropped if it isn't set there
+                if '=' not in value:
+                    if value not in os.environ:
+                        continue
+                    value = '%s=%s' % (value, os.environ[value])
+                target.setdefault(field, []).append(value)
+            elif kind == 'map':
+                key, _, label = value.partition('=')
+                target.setdefault(field, {})[key] = label
+            elif kind == 'bytes':
+                target[field] = -1 if value == '-1' else to_bytes(value)
+            elif kind == 'int':
+                target[field] = int(value)
+            elif kind == 'bool':
+                target[field] = value.lower() != 'false'
+            elif kind == 'volume':
+                if ':' in value:
+                    body['HostConfig'].setdefault('Binds', []).append(value)
+                else:
+                    body.setdefault('Volumes', {})[value] = {}
+            elif kind == 'ulimit':
+                ulimit, _, limits = value.partition('=')
+                soft, _, hard = limits.partition(':')
+                target.setdefault(field, []).append({'Name': ulimit, 'Soft': int(soft), 'Hard': int(hard or soft)})
+        except ValueError:
+            return None
+
+    return name, body
+
+def indent_json(raw, indent='    '):
+    """
+    Indent compact JSON the way the docker CLI does (Go's json.Indent),
+    keeping dockerd's own string escapes and number formatting
+    """
+    out = []
+    depth = 0
+    in_string = escaped = need_indent = False
+    for c in raw:
+        if in_string:
+            out.append(c)
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                in_string = False
+            continue
+        if c in ' \t\r\n':
+            continue
+        if need_indent and c not in ']}':
+            out.append('\n' + indent * depth)
+        if c in ']}':
+            depth -= 1
+            if not need_indent:
+                out.append('\n' + indent * depth)
+        need_indent = False
+        if c == '"':
+            in_string = True
+            out.append(c)
+        elif c in '[{':
+            out.append(c)
+            depth += 1
+            need_indent = True
+        elif c == ',':
+            out.append(',\n' + indent * depth)
+        elif c == ':':
+            out.append(': ')
+        else:
+            out.append(c)
+    return ''.join(out)
+
+def api_create(api, argv):
+    request = api_create_request(argv)
+    if request is None:
+        return None
+    name, body = request
+    path = '/containers/create'
+    if name:
+        path += '?' + urlencode({'name': name})
+    status, data = api.request('POST', path, body)
+    if status == 404:
+        # the image needs pulling, which is left to the CLI
+        return None
+    if status != 201:
+        return 1, b'', ('Error response from daemon: %s\n' % error_message(data)).encode()
+    created = json.loads(data.decode())
+    warnings = ''.join('WARNING: %s\n' % warning for warning in created.get('Warnings') or [])
+    return 0, ('%s\n' % created['Id']).encode(), warnings.encode()
+
+def api_rm(api, argv):
+    try:
+        options, names = split_options(argv, {'--force', '--volumes'}, RM_ALIASES)
+    except ValueError:
+        return None
+    query = {}
+    for option, value in options:
+        if option not in ('--force', '--volumes') or value.lower() == 'false':
+            return None
+        query['force' if option == '--force' else 'v'] = 1
+    if not names:
+        return None
+
+    rc = 0
+    output = []
+    errors = []
+    for name in names:
+        path = '/containers/%s' % quote(name, safe='')
+        if query:
+            path += '?' + urlencode(query)
+        status, data = api.request('DELETE', path)
+        if status == 204:
+            output.append('%s\n' % name)
+        else:
+            errors.append('Error response from daemon: %s\n' % error_message(data))
+            rc = 1
+    return rc, ''.join(output).encode(), ''.join(errors).encode()
+
+def api_inspect(api, argv):
+    try:
+        options, names = split_options(argv, set(), {})
+    except ValueError:
+        return None
+    # --format templates and other object types are left to the CLI
+    if any(option != '--type' or value != 'container' for option, value in options) or not names:
+        return None
+
+    containers = []
+    for name in names:
+        status, data = api.request('GET', '/containers/%s/json' % quote(name, safe=''))
+        if status != 200:
+            return None
+        containers.append(data.decode(errors='surrogateescape').strip())
+    output = indent_json('[' + ','.join(containers) + ']') + '\n'
+    return 0, output.encode(errors='surrogateescape'), b''
+
+API_COMMANDS = {
+    'create': api_create,
+    'rm': api_rm,
+    'inspect': api_inspect,
+}
+
+def api_execute(docker_command, args):
+    """
+    Run the command with Engine API requests, if the backend is enabled and
+    understands it. Returns the exit code, stdout and stderr, or None if the
+    CLI should be used.
+    """
+    if not DOCKER_API['enabled'] or docker_command not in API_COMMANDS:
+        return None
+    api = DockerAPI(DOCKER_API['socket'], DOCKER_API['timeout'])
+    try:
+        try:
+            api.connect()
+        except OSError:
+            return None
+        return API_COMMANDS[docker_command](api, args)
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        return 1, b'', ('error during connect: %s\n' % e).encode()
+    finally:
+        api.close()
+
+def cli_execute(args):
+    """
+    Run the command and capture its output, for results that are shared
+    """
     p = Popen(args, stdout=PIPE, stderr=PIPE)
     output, err = p.communicate()
-    sys.stdout.buffer.write(output)
-    sys.stderr.buffer.write(err)
-    exit(p.returncode)
+    # a command killed by a signal exits the way a shell would report it
+    rc = p.returncode if p.returncode >= 0 else 128 - p.returncode
+    return rc, output, err
+
+def cacheable(docker_command, args):
+    # stats only returns when it isn't streaming
+    return docker_command == 'inspect' or (docker_command == 'stats' and '--no-stream' in args)
+
+def read_generation():
+    cached = read_cache_file(COMMAND_CACHE['generation'])
+    try:
+        return cached['generation']
+    except (KeyError, TypeError):
+        return 0
+
+def invalidate_cache():
+    """
+    Make every cached result stale, as a container has been created,
+    removed or has changed state. Old entries are tidied up as we go.
+    """
+    try:
+        with open_private(COMMAND_CACHE['generation'] + '.lock', os.O_WRONLY | os.O_CREAT | os.O_APPEND, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            write_cache_file(COMMAND_CACHE['generation'], {'generation': read_generation() + 1})
+        expired = time.time() - COMMAND_CACHE['expire']
+        for entry in os.scandir(COMMAND_CACHE['dir']):
+            if entry.name.startswith('cmd-') and entry.stat().st_mtime < expired:
+                os.unlink(entry.path)
+    except OSError:
+        pass
+
+def fresh_result(filename, ttl):
+    cached = read_cache_file(filename)
+    try:
+        if cached['generation'] == read_generation() and 0 <= time.time() - cached['time'] < ttl:
+            return cached['rc'], b64decode(cached['stdout']), b64decode(cached['stderr'])
+    except (KeyError, TypeError, ValueError):
+        pass
+    return None
+
+def cached_execute(docker_command, args, run):
+    """
+    Return a recent result of the same read only command, or call run for a new one.
+    Identical requests made at the same time wait for one of them to run and share its result.
+    """
+    key = hashlib.sha1(json.dumps([docker_command] + args).encode()).hexdigest()
+    filename = os.path.join(COMMAND_CACHE['dir'], 'cmd-%s.json' % key)
+    ttl = COMMAND_CACHE['ttl'][docker_command]
+
+    result = fresh_result(filename, ttl)
+    if result:
+        return result
+
+    try:
+        lock = open_private(os.path.join(COMMAND_CACHE['dir'], 'cmd-%s.lock' % key), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 'a')
+    except OSError:
+        return run()
+
+    with lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # someone else may have run it while we waited
+        result = fresh_result(filename, ttl)
+        if result:
+            return result
+
+        generation = read_generation()
+        started = time.time()
+        result = run()
+        rc, output, err = result
+        if rc == 0:
+            write_cache_file(filename, {
+                'generation': generation,
+                'time': started,
+                'rc': rc,
+                'stdout': b64encode(output).decode(),
+                'stderr': b64encode(err).decode(),
+            })
+    return result
 
 
 # ==============================================================================
 #   main
 # ==============================================================================
 
-docker_command = sys.argv[1]
-dargs = ['/usr/bin/sudo', '/usr/bin/docker', docker_command]
+def main():
+    docker_command = sys.argv[1]
 
-if docker_command == 'create':
-    dargs += args_create(sys.argv[2:])
-elif docker_command == 'run':
-    dargs += args_run(sys.argv[2:])
-else:
-    dargs += args_other_commands(sys.argv[2:])
+    if docker_command == 'create':
+        args = args_create(sys.argv[2:])
+    elif docker_command == 'run':
+        args = args_run(sys.argv[2:])
+    else:
+        args = args_other_commands(sys.argv[2:])
+
+    dargs = ['/usr/bin/sudo', '/usr/bin/docker', docker_command] + args
+
+    if os.environ.get('DOCKER_WRAPPER_DEBUG'):
+        execute(['/bin/echo'] + dargs)
+
+    if docker_command in COMMAND_CACHE['invalidate']:
+        invalidate_cache()
 
-if os.environ.get('DOCKER_WRAPPER_DEBUG'):
-    dargs = ['/bin/echo'] + dargs
+    if cacheable(docker_command, args):
+        result = cached_execute(docker_command, args, lambda: api_execute(docker_command, args) or cli_execute(dargs))
+    else:
+        result = api_execute(docker_command, args)
+        if result is None:
+            if docker_command in COMMAND_CACHE['invalidate'] and docker_command not in COMMAND_CACHE['attached']:
+                # wait for it, so results cached while it ran (a container still running, say) are made stale once it's done
+                rc = wait_execute(dargs)
+                invalidate_cache()
+                exit_as(rc)
+            execute(dargs)
+        if docker_command in COMMAND_CACHE['invalidate']:
+            invalidate_cache()
+
+    rc, output, err = result
+    sys.stdout.buffer.write(output)
+    sys.stderr.buffer.write(err)
+    sys.exit(rc)
 
-execute(dargs)
+if __name__ == '__main__':
+    main()
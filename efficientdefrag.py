@@ -7,28 +7,107 @@ Identify demand for draining machines
 Kill preemptable jobs if a 8 core job can fit in their place
 Add / Remove jobs from the PREEMPTABLE_ONLY state."""
 
-import htcondor
 import datetime
 import subprocess
 import socket
+import select
+import errno
+import resource
 from operator import attrgetter
 import sys
 import time
 import os
 import logging
 import fcntl
+import bisect
+import heapq
+from contextlib import contextmanager
+import argparse
+import json
+
+try:
+    import htcondor
+except ImportError:
+    #not needed to replay a snapshot with --replay
+    htcondor = None
+import threading
+import Queue
 
 JOB_THRESHOLDS = {
     'idle' : 20,
     'running' : 300,
 }
 
+#slot sizes that machines are drained for, idle jobs are counted against the smallest size they fit in
+#and jobs bigger than all of them want a WHOLE_NODE
+DRAIN_SLOT_SIZES = [8, 16]
+WHOLE_NODE = 'whole'
+
 CONCURRECY = {
     'low' : 20,
     'high' : 60,
     'default' : 2,
 }
 
+#each schedd is queried on a thread of its own, so hung schedds can not hold up the others
+SCHEDD_QUERY = {
+    'timeout' : 120,
+}
+
+RECONFIG = {
+    'threads' : 16,
+    'timeout' : 300,
+}
+
+#how long killed jobs are given to vacate before a machine is released, and how often to check
+VACATE = {
+    'timeout' : 10,
+    'poll_interval' : 2,
+}
+
+#ensure a machine is in the correct state to run jobs
+#allow non preemptable jobs to run (if jobs could run) and allow jobs to run
+RELEASE_SETTINGS = [("PREEMPTABLE_ONLY", "False"), ("StartJobs", "True")]
+
+#the CPUs a machine is being drained to free are recorded next to PREEMPTABLE_ONLY=True,
+#so later cycles keep draining it until a slot of that size is free
+DRAIN_SLOT_SIZE = "DRAIN_SLOT_SIZE"
+
+#the condor shared port, used to check that nodes can be contacted. Every node is probed at once,
+#each connection is given timeout seconds and the whole probe deadline seconds; names are looked up
+#on threads, and at most max_open connections (less than the open file limit) are open at a time
+REACHABILITY = {
+    'port' : 9618,
+    'timeout' : 5,
+    'deadline' : 10,
+    'threads' : 64,
+    'max_open' : 4096,
+}
+
+#only look at these worker nodes
+CLUSTER_CONSTRAINT = 'RalCluster =!= "wn-cloud" && ClusterName =!= "wn-test" && RalCluster =!= "vm-nubes" && RalCluster =!= "vm-hyperv"'
+
+#and at their partitionable slots
+STARTD_CONSTRAINT = 'PartitionableSlot =?= True && ' + CLUSTER_CONSTRAINT
+
+#the same filtering as startd_is_candidate(), done by the collector
+CANDIDATE_CONSTRAINT = 'PREEMPTABLE_ONLY =!= UNDEFINED && NODE_IS_HEALTHY =?= True && StartJobs =?= True'
+
+#the only startd attributes the planner reads
+STARTD_ATTRIBUTES = ["Name", "Machine", "PartitionableSlot", "PREEMPTABLE_ONLY", "NODE_IS_HEALTHY", "StartJobs",
+                     "TotalCpus", "Cpus", "ShouldHibernate", "KILL_SIGNAL", "EFFICIENT_DRAIN", DRAIN_SLOT_SIZE]
+
+#how many machines to ask the collector about in one query
+MACHINE_QUERY_CHUNK = 200
+
+#daemon mode, seconds between cycles, how often to re-read the whole pool and
+#how far back to look for startd updates to cover clock differences with the collector
+DAEMON = {
+    'interval' : 300,
+    'full_refresh_cycles' : 12,
+    'clock_slack' : 60,
+}
+
 #full paths to these commands needed.
 CONDOR_RECONFIG='/usr/sbin/condor_reconfig'
 CONDOR_CONFIG_VAL='/usr/bin/condor_config_val'
@@ -38,24 +117,38 @@ FILENAME_MULTI_RUN_LOCK = '/var/run/efficientDrainingRunning'
 
 class Machine(object):
     """ Represents a single compute node """
-    name = None
-    rank = -10.0
-    preemptable_jobs = []
-    num_free = 0
-    num_preemptable = 0
-    total_cpus = 0
-    total_killable_cpus = 0
+    __slots__ = ('name', 'rank', 'cost', 'preemptable_jobs', 'preemptable_order', 'num_free', 'num_preemptable',
+                 'total_cpus', 'total_killable_cpus', 'kill_this_many', 'free_up_n_cpus')
 
     def __init__(self, name):
         self.name = name
+        self.rank = -10.0
+        # CPUs still to free for the smallest wanted slot size, comparable whatever the sizes
+        self.cost = 0
+        # Newest first, kept in order as jobs are added
+        self.preemptable_jobs = []
+        # Negated start times of preemptable_jobs, for bisecting
+        self.preemptable_order = []
+        self.num_free = 0
+        self.num_preemptable = 0
+        self.total_cpus = 0
+        self.total_killable_cpus = 0
+        self.kill_this_many = 0
+        # The slot size the machine is draining for, otherwise the smallest wanted size that fits on it
+        self.free_up_n_cpus = 0
+
+    def add_preemptable_job(self, job):
+        """ Adds job to preemptable_jobs, keeping them newest first"""
+        order = -(job.start_time or 0)
+        position = bisect.bisect_right(self.preemptable_order, order)
+        self.preemptable_order.insert(position, order)
+        self.preemptable_jobs.insert(position, job)
+        self.num_preemptable += 1
 
 
 class Job(object):
     """ Represents a single job """
-    job_id = None
-    global_id = None
-    schedd = None
-    start_time = None
+    __slots__ = ('job_id', 'global_id', 'start_time', 'schedd')
 
     def __init__(self, job_id, global_id, start_time, schedd):
         self.job_id = job_id
@@ -63,20 +156,223 @@ class Job(object):
         self.start_time = start_time
         self.schedd = schedd
 
-def persistent_set(hostname, daemon, atr, val):
-    """ Calls /usr/bin/condor_config_val to set a configuration variable persistently """
+class CycleStats(object):
+    """ Phase timings, counters and schedd latencies for a defrag cycle """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Starts counting for a new cycle"""
+        with self.lock:
+            self.start = time.time()
+            self.phases = dict()
+            self.counters = dict()
+            self.schedd_latencies = dict()
+
+    def count(self, name, value=1):
+        """ Adds value to the counter name"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def phase(self, name):
+        """ Times the code run inside the with block as phase name"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + time.time() - start
+
+    def observe_schedd(self, schedd, seconds):
+        """ Records how long a query to schedd took, a query that failed or timed out counts as the timeout"""
+        with self.lock:
+            self.schedd_latencies.setdefault(schedd, []).append(seconds)
+
+    def summary(self):
+        """ Returns the stats for the cycle as a dict"""
+        with self.lock:
+            return {
+                'start' : self.start,
+                'duration' : time.time() - self.start,
+                'phases' : dict(self.phases),
+                'counters' : dict(self.counters),
+                'schedd_latencies' : dict((schedd, max(latencies)) for schedd, latencies in self.schedd_latencies.items()),
+            }
+
+    def write_prometheus(self, filename):
+        """ Writes the stats for the cycle in the Prometheus text format, replacing filename atomically
+        so the node exporter textfile collector never reads a partial file"""
+        summary = self.summary()
+        lines = [
+            '# HELP efficientdefrag_last_cycle_start_seconds When the last defrag cycle started.',
+            '# TYPE efficientdefrag_last_cycle_start_seconds gauge',
+            'efficientdefrag_last_cycle_start_seconds %f' % summary['start'],
+            '# HELP efficientdefrag_last_cycle_duration_seconds How long the last defrag cycle took.',
+            '# TYPE efficientdefrag_last_cycle_duration_seconds gauge',
+            'efficientdefrag_last_cycle_duration_seconds %f' % summary['duration'],
+            '# HELP efficientdefrag_last_cycle_phase_seconds Time spent in each phase of the last defrag cycle.',
+            '# TYPE efficientdefrag_last_cycle_phase_seconds gauge',
+        ]
+        for name, seconds in sorted(summary['phases'].items()):
+            lines.append('efficientdefrag_last_cycle_phase_seconds{phase="%s"} %f' % (name, seconds))
+        lines.extend([
+            '# HELP efficientdefrag_last_cycle_events Round trips, subprocess spawns, nodes per category and errors in the last defrag cycle.',
+            '# TYPE efficientdefrag_last_cycle_events gauge',
+        ])
+        for name, value in sorted(summary['counters'].items()):
+            lines.append('efficientdefrag_last_cycle_events{event="%s"} %i' % (name, value))
+        #a gauge rather than a histogram, as the stats start again every cycle (and every run from cron)
+        lines.extend([
+            '# HELP efficientdefrag_last_cycle_schedd_query_seconds Latency of the query to each schedd in the last defrag cycle, the timeout if it failed or timed out.',
+            '# TYPE efficientdefrag_last_cycle_schedd_query_seconds gauge',
+        ])
+        for schedd, seconds in sorted(summary['schedd_latencies'].items()):
+            lines.append('efficientdefrag_last_cycle_schedd_query_seconds{schedd="%s"} %f' % (schedd, seconds))
+
+        temporary = '%s.%i.tmp' % (filename, os.getpid())
+        with open(temporary, 'w') as prometheus_file:
+            prometheus_file.write('\n'.join(lines) + '\n')
+        os.rename(temporary, filename)
+
+#the stats for the current cycle, reset at the start of each one
+STATS = CycleStats()
+
+class PreemptableJobs(object):
+    """ Index of the preemptable jobs in the pool, keyed by GlobalJobId """
+
+    def __init__(self):
+        self.jobs = dict()
+
+    def add(self, global_id, schedd, start_time):
+        """ Records a preemptable job along with the schedd that owns it"""
+        #there are only a handful of schedds, so share one copy of each name
+        self.jobs[global_id] = (intern(str(schedd)), start_time)
+
+    def get(self, global_id):
+        """ Returns (schedd, start_time) for the job, or None if it is not preemptable"""
+        return self.jobs.get(global_id)
+
+    def __contains__(self, global_id):
+        return global_id in self.jobs
+
+    def __len__(self):
+        return len(self.jobs)
+
+def persistent_set(hostname, daemon, settings):
+    """ Calls /usr/bin/condor_config_val to set a list of (attribute, value) configuration variables
+    persistently in one go, then reconfigures the daemon once. Returns True if both commands succeeded"""
     logger = logging.getLogger('condor_efficient_defrag')
-    set_string = '%s -name %s %s -set "%s = %s" && %s -name %s' % (CONDOR_CONFIG_VAL, hostname, daemon, atr, val, CONDOR_RECONFIG, hostname)
-    subprocess.Popen(set_string, shell=True, stdout=subprocess.PIPE).communicate()
-    logger.debug('Set %s, %s, %s = %s persistently', hostname, daemon, atr, val)
-
-
-def ping(hostname):
-    """ Returns true if (and only if) hostname is ping-able, else returns False"""
-    exit_code = subprocess.call(["/bin/ping", "-c", "1", hostname], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if exit_code == 0:
-        return True
-    return False
+    set_command = [CONDOR_CONFIG_VAL, '-name', hostname, daemon, '-set'] + ['%s = %s' % (atr, val) for atr, val in settings]
+    reconfig_command = [CONDOR_RECONFIG, '-name', hostname]
+
+    for command in (set_command, reconfig_command):
+        STATS.count('subprocess_spawns')
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = process.communicate()
+        if process.returncode != 0:
+            STATS.count('errors')
+            logger.error('%s failed on %s with exit code %i: %s', os.path.basename(command[0]), hostname, process.returncode, err.strip())
+            return False
+
+    for atr, val in settings:
+        logger.debug('Set %s, %s, %s = %s persistently', hostname, daemon, atr, val)
+    return True
+
+
+def reconfigure_machines(changes):
+    """ Applies changes, a dict of machine name -> list of (attribute, value), to the startds
+    of several machines in parallel. Returns a dict of machine name -> True/False for success"""
+    logger = logging.getLogger('condor_efficient_defrag')
+    names = list(changes)
+    results, errors, timed_out = run_concurrently(lambda name: persistent_set(name, "-startd", changes[name]),
+                                                  names, RECONFIG['threads'], RECONFIG['timeout'])
+
+    STATS.count('errors', len(errors) + len(timed_out))
+    for name, error in errors.items():
+        logger.error("Error reconfiguring %s: %s", name, error)
+    for name in timed_out:
+        logger.error("Reconfiguring %s did not finish within %i seconds.", name, RECONFIG['timeout'])
+
+    return dict((name, results.get(name, False)) for name in names)
+
+
+def resolve(hostname):
+    """ Returns the address to probe hostname on, as (family, type, protocol, sockaddr)"""
+    family, socktype, proto, _, sockaddr = socket.getaddrinfo(hostname, REACHABILITY['port'], 0, socket.SOCK_STREAM)[0]
+    return family, socktype, proto, sockaddr
+
+
+def probe_reachability(hostnames):
+    """ Checks that a TCP connection can be made to the condor port on all of hostnames at once,
+    with non-blocking sockets, within REACHABILITY['deadline'] seconds.
+    Returns a dict of hostname -> True/False, or None if it could not be probed in time,
+    to be used as the cache for this run"""
+    hostnames = list(set(hostnames))
+    deadline = time.time() + REACHABILITY['deadline']
+    reachable = dict((hostname, None) for hostname in hostnames)
+
+    #a name that does not resolve can not be contacted
+    addresses, errors, _ = run_concurrently(resolve, hostnames, REACHABILITY['threads'], REACHABILITY['deadline'])
+    for hostname in errors:
+        reachable[hostname] = False
+
+    #leave some file descriptors for everything else
+    max_open = REACHABILITY['max_open']
+    open_files, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if open_files != resource.RLIM_INFINITY:
+        max_open = max(min(max_open, open_files - 64), 1)
+
+    waiting = list(addresses.items())
+    waiting.reverse()
+    poller = select.poll()
+    connecting = dict()
+    try:
+        while waiting or connecting:
+            now = time.time()
+            if now >= deadline:
+                break
+            while waiting and len(connecting) < max_open:
+                hostname, (family, socktype, proto, sockaddr) = waiting.pop()
+                try:
+                    sock = socket.socket(family, socktype, proto)
+                except socket.error:
+                    #out of file descriptors, try again once some connections are done
+                    waiting.append((hostname, (family, socktype, proto, sockaddr)))
+                    max_open = len(connecting)
+                    break
+                sock.setblocking(0)
+                error = sock.connect_ex(sockaddr)
+                if error in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                    poller.register(sock.fileno(), select.POLLOUT)
+                    connecting[sock.fileno()] = (sock, hostname, min(now + REACHABILITY['timeout'], deadline))
+                else:
+                    reachable[hostname] = error == 0
+                    sock.close()
+            if not connecting:
+                break
+
+            wait = min(expires for _, _, expires in connecting.values()) - time.time()
+            for fd, _ in poller.poll(max(int(wait * 1000) + 1, 0)):
+                sock, hostname, _ = connecting.pop(fd)
+                poller.unregister(fd)
+                reachable[hostname] = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+                sock.close()
+
+            #connections past their timeout did not answer, the ones cut short by the deadline are not known
+            now = time.time()
+            for fd, (sock, hostname, expires) in list(connecting.items()):
+                if expires <= now and expires < deadline:
+                    del connecting[fd]
+                    poller.unregister(fd)
+                    reachable[hostname] = False
+                    sock.close()
+    finally:
+        for sock, _, _ in connecting.values():
+            sock.close()
+    return reachable
 
 
 def get_collector(hostname=socket.gethostname()):
@@ -85,6 +381,7 @@ def get_collector(hostname=socket.gethostname()):
     condor_collector = htcondor.Collector(hostname)
     try:
         # Test the connection with a simple query
+        STATS.count('collector_queries')
         condor_collector.locateAll(htcondor.DaemonTypes.Collector)
     except IOError:
         logger.error("Failed to connect to collector %s, exiting.", socket.gethostname())
@@ -95,67 +392,166 @@ def get_collector(hostname=socket.gethostname()):
 def get_schedd_hosts(condor_collector):
     """ Returns a list of the hosts with a condor_schedd on them"""
     logger = logging.getLogger('condor_efficient_defrag')
+    STATS.count('collector_queries')
     hosts = condor_collector.query(htcondor.AdTypes.Schedd, "true", ["Name"])
     if not hosts: #ie no schedds
         logger.error("No schedds found, exiting!")
         sys.exit()
     return [h['Name'] for h in hosts]
 
-def update_jobs_list(condor_collector, hostname):
-    """ Queries the schedds to generate a list of preemptable jobs"""
-    logger = logging.getLogger('condor_efficient_defrag')
-
-    condor_schedd = htcondor.Schedd(condor_collector.locate(htcondor.DaemonTypes.Schedd, hostname))
-
-    jobs = []
-    pjobs = []
-
+def run_concurrently(function, items, max_threads, timeout):
+    """ Calls function(item) for every item on up to max_threads worker threads.
+    Waits at most timeout seconds and returns three values: a dict of item -> result
+    for the calls that finished, a dict of item -> exception for the calls that raised,
+    and a list of the items that had not finished by the deadline. Of those, the ones
+    that had not started are never started, the rest may still finish later"""
+    results = dict()
+    errors = dict()
+    if not items:
+        return results, errors, []
+
+    lock = threading.Lock()
+    finished = threading.Event()
+    cancelled = threading.Event()
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+    remaining = [len(items)]
+    #workers can outlive the deadline, and module globals are None once the interpreter is shutting down
+    empty = Queue.Empty
+
+    def worker():
+        while True:
+            with lock:
+                if cancelled.is_set():
+                    return
+                try:
+                    item = pending.get_nowait()
+                except empty:
+                    return
+            try:
+                result = function(item)
+                with lock:
+                    results[item] = result
+            except Exception as error:
+                with lock:
+                    errors[item] = error
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    finished.set()
+
+    for _ in range(min(max_threads, len(items))):
+        #daemon threads, so a hung call can not stop the script from exiting
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    finished.wait(timeout)
+
+    with lock:
+        cancelled.set()
+        timed_out = [item for item in items if item not in results and item not in errors]
+        return dict(results), dict(errors), timed_out
+
+def get_schedd_jobs(schedds, hostname):
+    """ Queries a schedd once for its multicore and preemptable jobs"""
+    condor_schedd = schedds.get(hostname)
+    STATS.count('schedd_queries')
     try:
-       jobs = condor_schedd.query('isPreemptable =?= True', ["GlobalJobId"])
-    except ValueError:
-        logger.error("Caught ValueError - could not connect to schedd on %s, skipping reading jobs in queue.", hostname)
-    except IOError:
-        logger.error("Caught IOError - could not connect to schedd on %s, skipping reading jobs in queue.", hostname)
-
-    for job in jobs:
-       pjobs.append(job["GlobalJobId"])
-
-    return pjobs
-
-def get_schedd_jobs(condor_collector, hostname):
-    """ Queries the schedds to determine how many multicore jobs are running and idle"""
+        return condor_schedd.query('RequestCpus>1 || isPreemptable =?= True', ["JobStatus", "RequestCpus", "GlobalJobId", "isPreemptable", "JobCurrentStartDate"])
+    except Exception:
+        schedds.invalidate(hostname)
+        raise
+
+def summarise_schedd_jobs(schedd_jobs):
+    """ Counts the running and idle multicore jobs and indexes the preemptable jobs.
+    schedd_jobs is a dict of schedd name -> jobs from get_schedd_jobs().
+    Returns the job counts, with the idle jobs also counted by slot size in 'idle_by_size', and a PreemptableJobs"""
+    job_counts = dict()
+    job_counts['idle'] = 0
+    job_counts['running'] = 0
+    job_counts['idle_by_size'] = dict()
+    preemptable_jobs = PreemptableJobs()
+
+    for schedd_name, jobs in schedd_jobs.items():
+        for job in jobs:
+            if "isPreemptable" in job and job["isPreemptable"] == True:
+                start_time = None
+                if "JobCurrentStartDate" in job:
+                    start_time = job["JobCurrentStartDate"]
+                preemptable_jobs.add(job["GlobalJobId"], schedd_name, start_time)
+            if int(job["RequestCpus"]) > 1:
+                if int(job["JobStatus"]) == 2:
+                    job_counts['running'] += 1
+                if int(job["JobStatus"]) == 1:
+                    job_counts['idle'] += 1
+                    size = slot_size(int(job["RequestCpus"]))
+                    job_counts['idle_by_size'][size] = job_counts['idle_by_size'].get(size, 0) + 1
+
+    return job_counts, preemptable_jobs
+
+def slot_size(request_cpus):
+    """ Returns the smallest of DRAIN_SLOT_SIZES that request_cpus fits in, or WHOLE_NODE"""
+    for size in sorted(DRAIN_SLOT_SIZES):
+        if request_cpus <= size:
+            return size
+    return WHOLE_NODE
+
+def share_budget(budget, demand):
+    """ Splits budget draining machines between slot sizes in proportion to demand,
+    a dict of slot size -> idle jobs, using largest remainders. Returns a dict of slot size -> machines"""
+    total = sum(demand.values())
+    if budget <= 0 or total <= 0:
+        return dict((size, 0) for size in demand)
+    shares = dict((size, budget * count // total) for size, count in demand.items())
+    by_remainder = sorted(demand, key=lambda size: (budget * demand[size]) % total, reverse=True)
+    for size in by_remainder[:budget - sum(shares.values())]:
+        shares[size] += 1
+    return shares
+
+def get_all_schedd_jobs(schedds, hostnames):
+    """ Queries all schedds at once, one thread each, giving each one SCHEDD_QUERY['timeout'] seconds to respond.
+    Returns a dict of hostname -> jobs for the schedds that answered in time"""
     logger = logging.getLogger('condor_efficient_defrag')
-    jobs = []
 
-    condor_schedd = htcondor.Schedd(condor_collector.locate(htcondor.DaemonTypes.Schedd, hostname))
+    latencies = dict()
+    def query(hostname):
+        start = time.time()
+        jobs = get_schedd_jobs(schedds, hostname)
+        latencies[hostname] = time.time() - start
+        return jobs
 
-    try:
-        jobs = condor_schedd.query('RequestCpus>1', ["JobStatus", "RequestCpus"])
-    except ValueError:
-        logger.error("Caught ValueError - could not connect to schedd on %s, skipping reading jobs in queue.", hostname)
-    except IOError:
-        logger.error("Caught IOError - could not connect to schedd on %s, skipping reading jobs in queue.", hostname)
+    #there are only about a dozen schedds, so every query starts straight away
+    results, errors, timed_out = run_concurrently(query, hostnames, len(hostnames), SCHEDD_QUERY['timeout'])
 
-    running = idle = 0
-    for job in jobs:
-        if int(job["JobStatus"]) == 2:
-            running += 1
-        if int(job["JobStatus"]) == 1:
-            idle += 1
+    #schedds that failed or did not answer are recorded as taking the timeout, so they stand out
+    for hostname in hostnames:
+        STATS.observe_schedd(hostname, latencies[hostname] if hostname in results else SCHEDD_QUERY['timeout'])
 
-    return running, idle
+    STATS.count('errors', len(errors) + len(timed_out))
+    for hostname, error in errors.items():
+        logger.error("Caught %s - could not connect to schedd on %s, skipping reading jobs in queue.", type(error).__name__, hostname)
+    for hostname in timed_out:
+        logger.error("Schedd on %s did not answer within %i seconds, skipping reading jobs in queue.", hostname, SCHEDD_QUERY['timeout'])
+    if errors or timed_out:
+        logger.warning("Using partial results from %i of %i schedds.", len(results), len(hostnames))
 
+    return results
 
-def get_startds(condor_collector, constraint=""):
-    """ Gets the startd from all worker nodes in pool"""
+def get_startds(condor_collector, constraint="", required=True, projection=STARTD_ATTRIBUTES):
+    """ Gets the startd from all worker nodes in pool, with only the attributes in projection.
+    If required, exits when none are found"""
     logger = logging.getLogger('condor_efficient_defrag')
     try:
-        results = condor_collector.query(htcondor.AdTypes.Startd, constraint)
+        STATS.count('collector_queries')
+        results = condor_collector.query(htcondor.AdTypes.Startd, constraint, projection)
     except IOError:
+        STATS.count('errors')
         logger.error("Error: Failed to read startds, exiting.")
         sys.exit()
 
-    if not results:
+    if not results and required:
         logger.error("No startds found, exiting.")
         sys.exit()
 
@@ -172,15 +568,29 @@ def calculate_concurrency(job_counts):
     else:
         return CONCURRECY['default']
 
-def kill_jobs(condor_collector, machine, number_to_kill):
-    """ Kills number_to_kill many jobs from the preemptable jobs on machine, newest first"""
+def kill_jobs(schedds, jobs):
+    """ Kills jobs, sending a single remove action to each schedd for all of its jobs.
+    Returns the GlobalJobIds of the jobs removed"""
     logger = logging.getLogger('condor_efficient_defrag')
-    for job in machine.preemptable_jobs[0:number_to_kill]:
-        #need to send action to right collector
-        schedd_ad = condor_collector.locate(htcondor.DaemonTypes.Schedd, job.schedd)
-        schedd = htcondor.Schedd(schedd_ad)
-        schedd.act(htcondor.JobAction.Remove, 'GlobalJobId=="%s"' % job.global_id)
-        logger.debug('Killed %s, started at: %s', job.global_id, job.start_time)
+    jobs_by_schedd = dict()
+    for job in jobs:
+        jobs_by_schedd.setdefault(job.schedd, []).append(job)
+
+    killed = []
+    for schedd_name, schedd_jobs in jobs_by_schedd.items():
+        #need to send action to right schedd
+        try:
+            STATS.count('schedd_actions')
+            schedds.get(schedd_name).act(htcondor.JobAction.Remove, [str(job.job_id) for job in schedd_jobs])
+        except (IOError, RuntimeError, ValueError) as error:
+            STATS.count('errors')
+            schedds.invalidate(schedd_name)
+            logger.warning("%s removing %i jobs from %s, skipping.", type(error).__name__, len(schedd_jobs), schedd_name)
+            continue
+        for job in schedd_jobs:
+            logger.debug('Killed %s, started at: %s', job.global_id, job.start_time)
+            killed.append(job.global_id)
+    return killed
 
 def startd_will_hibernate(condor_startd, machine):
     """ Returns true if machine is about to hibernate"""
@@ -203,53 +613,211 @@ def startd_is_being_emptied(condor_startd):
         return True
     return False
 
-def get_running_jobs(machine, condor_collector):
-    """ Gets the running jobs from machine"""
+def startd_drain_slot_size(condor_startd):
+    """ Returns the CPUs condor_startd was set to drain for, or None if that was not recorded"""
+    try:
+        return float(int(str(condor_startd[DRAIN_SLOT_SIZE])))
+    except (KeyError, ValueError):
+        return None
+
+def startd_is_candidate(condor_startd):
+    """ Returns true if condor_startd is a partitionable slot that supports efficient draining,
+    is healthy and could run jobs"""
+    if (
+            "PartitionableSlot" in condor_startd and
+            "PREEMPTABLE_ONLY" in condor_startd and
+            "NODE_IS_HEALTHY" in condor_startd and
+            condor_startd["NODE_IS_HEALTHY"] == True and
+            condor_startd["StartJobs"] == True
+        ):
+        return True
+    return False
+
+def get_running_jobs(condor_collector, machines=None):
+    """ Gets the running jobs from every machine in one collector query (or only those in machines,
+    MACHINE_QUERY_CHUNK at a time), indexed by machine name. Returns None if the collector failed"""
     logger = logging.getLogger('condor_efficient_defrag')
-    jobs = []
+    running_jobs = dict()
+    constraint = 'JobId =!= UNDEFINED && ' + CLUSTER_CONSTRAINT
+    if machines is None:
+        constraints = [constraint]
+    else:
+        machines = list(machines)
+        constraints = [constraint + ' && (%s)' % ' || '.join('Machine=="%s"' % machine for machine in machines[i:i + MACHINE_QUERY_CHUNK])
+                       for i in range(0, len(machines), MACHINE_QUERY_CHUNK)]
     try:
-        jobs = condor_collector.query(htcondor.AdTypes.Startd, 'Machine=="%s"' % machine, ["JobId", "ClientMachine", "GlobalJobId", "EnteredCurrentActivity"])
+        for constraint in constraints:
+            STATS.count('collector_queries')
+            for job in condor_collector.query(htcondor.AdTypes.Startd, constraint, ["JobId", "GlobalJobId", "EnteredCurrentActivity", "Machine"]):
+                running_jobs.setdefault(str(job["Machine"]), []).append(job)
     except IOError:
-        logger.error("Collector Error: Failed to get jobs from machine %s.\n", machine.name)
-    return jobs
-
-def get_schedd(client, condor_collector):
-    """ Gets the schedd deamon runnning on Client"""
-    schedd_ad = condor_collector.locate(htcondor.DaemonTypes.Schedd, client)
-    return htcondor.Schedd(schedd_ad)
-
-def main():
-    """ Main function, called when module is run as a CLI application """
-    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s')
+        STATS.count('errors')
+        logger.error("Collector Error: Failed to get running jobs.\n")
+        return None
+
+    return running_jobs
+
+def release_after_vacate(condor_collector, vacating):
+    """ Lets machines run jobs again once their killed jobs have left.
+    vacating is a dict of machine name -> (deadline, GlobalJobIds killed). A machine is released when
+    the collector no longer shows any of its killed jobs, or at its deadline, whichever comes first.
+    Returns a dict of machine name -> True/False for whether it was released"""
+    released = dict()
+    while vacating:
+        time.sleep(max(min(VACATE['poll_interval'], min(deadline for deadline, _ in vacating.values()) - time.time()), 0))
+
+        now = time.time()
+        #if the collector failed nothing is known to have vacated, so machines only go at their deadline
+        still_running = get_running_jobs(condor_collector, vacating.keys())
+        ready = []
+        for name, (deadline, global_ids) in vacating.items():
+            if deadline <= now:
+                ready.append(name)
+            elif still_running is not None:
+                running_ids = set(job["GlobalJobId"] for job in still_running.get(name, []))
+                if not global_ids & running_ids:
+                    ready.append(name)
+
+        released.update(reconfigure_machines(dict((name, RELEASE_SETTINGS) for name in ready)))
+        for name in ready:
+            del vacating[name]
+    return released
+
+class ScheddCache(object):
+    """ Located schedd handles, shared by everything that talks to schedds during a run """
+
+    def __init__(self, condor_collector):
+        self.condor_collector = condor_collector
+        self.schedds = dict()
+        self.lock = threading.Lock()
+
+    def get(self, hostname):
+        """ Gets the schedd deamon runnning on hostname, locating it on first use"""
+        with self.lock:
+            schedd = self.schedds.get(hostname)
+        if schedd is None:
+            STATS.count('collector_queries')
+            schedd = htcondor.Schedd(self.condor_collector.locate(htcondor.DaemonTypes.Schedd, hostname))
+            with self.lock:
+                self.schedds[hostname] = schedd
+        return schedd
+
+    def invalidate(self, hostname):
+        """ Forgets the handle for hostname after an error, so it is located again next time"""
+        with self.lock:
+            self.schedds.pop(hostname, None)
+
+class PoolModel(object):
+    """ The view of the pool that is kept between cycles in daemon mode.
+    A full refresh reads every schedd, startd and running job. In between, only the startds the
+    collector has heard from since the last refresh (and the jobs on those machines) are re-read,
+    along with the schedds and the names of the startds, to drop those the collector no longer has """
+
+    def __init__(self, condor_collector, full_refresh_cycles=1):
+        self.condor_collector = condor_collector
+        self.schedds = ScheddCache(condor_collector)
+        self.full_refresh_cycles = max(full_refresh_cycles, 1)
+        self.schedd_hosts = []
+        self.startds = dict()
+        self.running_jobs = dict()
+        self.cycle = 0
+        self.last_refresh = None
+        self.full_refresh_needed = True
+
+    def invalidate(self):
+        """ Makes the next refresh a full one"""
+        self.full_refresh_needed = True
+
+    def refresh(self):
+        """ Brings the model up to date with the collector"""
+        logger = logging.getLogger('condor_efficient_defrag')
+        refresh_time = time.time()
+        self.schedd_hosts = get_schedd_hosts(self.condor_collector)
+
+        if self.full_refresh_needed or self.cycle % self.full_refresh_cycles == 0:
+            self.startds = dict((str(startd["Name"]), startd) for startd in get_startds(self.condor_collector, '(%s) && %s' % (STARTD_CONSTRAINT, CANDIDATE_CONSTRAINT)))
+            self.running_jobs = get_running_jobs(self.condor_collector) or dict()
+            self.cycle = 0
+            self.full_refresh_needed = False
+            logger.info("Full refresh: %i startds, %i machines running jobs", len(self.startds), len(self.running_jobs))
+        else:
+            since = int(self.last_refresh - DAEMON['clock_slack'])
+            #not filtered on CANDIDATE_CONSTRAINT, so machines that stop being candidates are seen and dropped
+            changed = get_startds(self.condor_collector, '(%s) && LastHeardFrom >= %i' % (STARTD_CONSTRAINT, since), required=False)
+            machines = set()
+            for startd in changed:
+                if startd_is_candidate(startd):
+                    self.startds[str(startd["Name"])] = startd
+                else:
+                    self.startds.pop(str(startd["Name"]), None)
+                machines.add(str(startd["Machine"]))
+
+            #a startd that goes away is never heard from again, only its ad expires from the collector,
+            #so drop the ones whose names it no longer has
+            vanished = set()
+            names = get_startds(self.condor_collector, STARTD_CONSTRAINT, required=False, projection=["Name"])
+            if names:
+                present = set(str(startd["Name"]) for startd in names)
+                for name in [name for name in self.startds if name not in present]:
+                    vanished.add(str(self.startds.pop(name)["Machine"]))
+
+            #startds send an update every UPDATE_INTERVAL even when nothing has changed, so with a long
+            #enough interval most machines show up, and one query for every job is cheaper than asking by name
+            known = set(str(startd["Machine"]) for startd in self.startds.values()) | set(self.running_jobs)
+            everything = len(machines) * 2 > len(known)
+            running_jobs = get_running_jobs(self.condor_collector, None if everything else machines)
+            if running_jobs is None:
+                #can not tell which jobs have finished, so start again next cycle
+                self.invalidate()
+                running_jobs = dict()
+            if everything:
+                self.running_jobs = running_jobs
+            else:
+                for machine in machines:
+                    if machine in running_jobs:
+                        self.running_jobs[machine] = running_jobs[machine]
+                    else:
+                        self.running_jobs.pop(machine, None)
+            for machine in vanished - machines:
+                self.running_jobs.pop(machine, None)
+            logger.info("Incremental refresh: %i startds on %i machines changed, %i machines gone", len(changed), len(machines), len(vanished))
+
+        self.cycle += 1
+        self.last_refresh = refresh_time
+
+
+class Plan(object):
+    """ The actions a cycle should take, as worked out by plan_cycle() """
+
+    def __init__(self):
+        self.max_concurrent_draining = 0
+        # How many machines were draining when the plan was made
+        self.machines_draining = 0
+        # Machines which have finished draining, to be allowed to run any job again
+        self.drain_finished = []
+        # Machines to kill jobs on first, each with kill_this_many and preemptable_jobs newest first
+        self.kills = []
+        # Machines which should have draining cancelled
+        self.cancels = []
+        # Machines which should start draining
+        self.drains = []
+
+
+def plan_cycle(startds, running_jobs, schedd_jobs, reachable, drain=True):
+    """ Works out what a cycle should do, without talking to the pool.
+    startds is a list of startd ads, running_jobs a dict of machine name -> running slot ads,
+    schedd_jobs a dict of schedd name -> jobs from get_schedd_jobs() and reachable a dict of
+    machine name -> True/False. Returns a Plan"""
     logger = logging.getLogger('condor_efficient_defrag')
-    logger.setLevel(logging.INFO)
+    plan = Plan()
+
     #---------------------------------------------------------------------------------
     #
     # Calculate demand for multicore slots
     #
     #---------------------------------------------------------------------------------
 
-    logger.info("Starting run at: %s", datetime.datetime.now())
-
-    #if not create_lock():
-    #    sys.exit(1)
-
-    job_counts = dict()
-    job_counts['idle'] = 0
-    job_counts['running'] = 0
-
-    condor_collector = get_collector()
-    condor_schedd_hosts = get_schedd_hosts(condor_collector)
-    condor_stards = get_startds(condor_collector, 'RalCluster =!= "wn-cloud" && ClusterName =!= "wn-test" && RalCluster =!= "vm-nubes" && RalCluster =!= "vm-hyperv"')
-
-    jobs_list = []
-
-    # Get job counts from as many schedds as possible
-    for condor_schedd_host in condor_schedd_hosts:
-        running, idle = get_schedd_jobs(condor_collector, condor_schedd_host)
-        job_counts['running'] += running
-        job_counts['idle'] += idle
-        jobs_list.extend(update_jobs_list(condor_collector, condor_schedd_host))
+    job_counts, preemptable_jobs = summarise_schedd_jobs(schedd_jobs)
 
     logger.debug('Idle multicore jobs = %(idle)i', job_counts)
     logger.debug('Running multicore jobs = %(running)i', job_counts)
@@ -257,12 +825,11 @@ def main():
     # Set max concurrent draining machines based on demand
     max_concurrent_draining = calculate_concurrency(job_counts)
 
-    drain = True
-    if os.path.isfile(FILENAME_INHIBIT_DRAINING):
-        drain = False
+    if not drain:
         max_concurrent_draining = 0
 
     logger.debug('Max concurrent draining machines = %i', max_concurrent_draining)
+    plan.max_concurrent_draining = max_concurrent_draining
 
     #---------------------------------------------------------------------------------
     #
@@ -271,7 +838,14 @@ def main():
     #
     #---------------------------------------------------------------------------------
 
-    # Machines which can be drained
+    # Slot sizes wanted by idle jobs, if nothing is waiting keep making slots of the smallest size
+    demand = dict(job_counts['idle_by_size'])
+    if not demand:
+        demand[min(DRAIN_SLOT_SIZES)] = 1
+    logger.debug('Idle multicore jobs by slot size = %s', demand)
+
+    # Machines which can be drained, as a heap per slot size of (key, name, CPUs to free, machine), best first
+    drain_heaps = dict((size, []) for size in demand)
     machines_can_drain = []
 
     # Machines which are draining but can be cancelled
@@ -282,87 +856,99 @@ def main():
 
     machines_draining = 0
 
-    #use a float here to force non integer ranks
-    free_up_n_cpus = 8.0
+    #only care about partitonable slots, that supports efficent draining, is healthy and could run jobs
+    for condor_startd in startds:
+        if not startd_is_candidate(condor_startd):
+            continue
 
+        machine = Machine(str(condor_startd["Machine"]))
 
-    for condor_startd in condor_stards:
-        #only care about partitonable slots, that supports efficent draining, is healthy and could run jobs
-        #also, dont fuss with nodes in the KILL_SIGNAL state
-        if (
-                "PartitionableSlot" in condor_startd and
-                "PREEMPTABLE_ONLY" in condor_startd and
-                "NODE_IS_HEALTHY" in condor_startd and
-                condor_startd["NODE_IS_HEALTHY"] == True and
-                condor_startd["StartJobs"] == True
-            ):
+        if reachable.get(machine.name) is None:
+            logger.warning("Could not tell if %s is contact-able, so skipping\n", machine.name)
+            continue
 
-            machine = Machine(str(condor_startd["Machine"]))
+        if not reachable[machine.name]:
+            logger.warning("%s not contact-able, so skipping\n", machine.name)
+            continue
 
-            #can we ping the machine
-            if not ping(machine.name):
-                logger.warning("%s not contact-able, so skipping\n", machine.name)
-                continue
+        #totalCpus is the number of cpus on the machine
+        machine.total_cpus = int(condor_startd["TotalCpus"])
 
-            #totalCpus is the number of cpus on the machine
-            machine.total_cpus = int(condor_startd["TotalCpus"])
+        #int(result["Cpus"]) is the number of cpus on the slot, because we are only querying partionable slots,
+        #this is effectively free cpus
+        machine.num_free = int(condor_startd["Cpus"])
 
-            #int(result["Cpus"]) is the number of cpus on the slot, because we are only querying partionable slots,
-            #this is effectively free cpus
-            machine.num_free = int(condor_startd["Cpus"])
+        if startd_will_hibernate(condor_startd, machine):
+            logger.info("Skipping %s because it is about to hibernate.\n\n", machine.name)
+            continue
 
-            if startd_will_hibernate(condor_startd, machine):
-                logger.info("Skipping %s because it is about to hibernate.\n\n", machine.name)
-                continue
+        if startd_is_fast_draining(condor_startd):
+            logger.info("Skipping %s because it is being fast hibernated.\n\n", machine.name)
+            continue
 
-            if startd_is_fast_draining(condor_startd):
-                logger.info("Skipping %s because it is being fast hibernated.\n\n", machine.name)
-                continue
+        if startd_is_being_emptied(condor_startd):
+            logger.info("Skipping %s because it is being efficently emptied.\n\n", machine.name)
+            continue
 
-            if startd_is_being_emptied(condor_startd):
-                logger.info("Skipping %s because it is being efficently emptied.\n\n", machine.name)
-                continue
+        #get the jos running on this machine
+        jobs = running_jobs.get(machine.name)
 
-            #get the jos running on this machine
-            jobs = get_running_jobs(machine.name, condor_collector)
+        if not jobs:
+            logger.info("No jobs found for %s, skipping.\n", machine.name)
+            continue
 
-            if not jobs:
-                logger.info("No jobs found for %s, skipping.\n", machine.name)
-                continue
+        #work out how many are preemptable
+        for job in jobs:
+            if "JobId" in job:
+                if job["GlobalJobId"] in preemptable_jobs:
+                    logger.debug("identified %s as preemptable", job["GlobalJobId"])
 
-            #work out how many are preemptable
-            machine.num_preemptable = 0
-            machine.preemptable_jobs = []
+                    schedd, _ = preemptable_jobs.get(job["GlobalJobId"])
+                    temp_job = Job(str(job["JobId"]), str(job["GlobalJobId"]), job["EnteredCurrentActivity"], schedd)
+                    machine.add_preemptable_job(temp_job)
+                else:
+                    logger.debug("identified %s as unpreemptable", job["GlobalJobId"])
 
-            for job in jobs:
-                if "JobId" in job:
-                    if job["GlobalJobId"] in jobs_list:
-                        machine.num_preemptable += 1
-                        logger.debug("identified %s as preemptable", job["GlobalJobId"])
+        logger.debug('Machine                %-4s', machine.name)
+        logger.debug('total CPUs             %-4s', machine.total_cpus)
+        logger.debug('free CPUs              %-4s', machine.num_free)
+        logger.debug('preemptable CPUs       %-4s', machine.num_preemptable)
 
-                        temp_job = Job(job["JobId"], job["GlobalJobId"], job["EnteredCurrentActivity"], job["ClientMachine"])
-                        machine.preemptable_jobs.append(temp_job)
-                    else:
-                        logger.debug("identified %s as unpreemptable", job["GlobalJobId"])
+        machine.total_killable_cpus = machine.num_free + machine.num_preemptable
 
-            logger.debug('Machine                %-4s', machine.name)
-            logger.debug('total CPUs             %-4s', machine.total_cpus)
-            logger.debug('free CPUs              %-4s', machine.num_free)
-            logger.debug('preemptable CPUs       %-4s', machine.num_preemptable)
+        logger.debug('total killable CPUs    %-4s', machine.total_killable_cpus)
 
-            machine.total_killable_cpus = machine.num_free + machine.num_preemptable
+        #the slot sizes wanted that could fit on this machine, use floats here to force non integer ranks
+        sizes = dict((size, float(machine.total_cpus if size == WHOLE_NODE else size)) for size in demand)
+        sizes = dict((size, cpus) for size, cpus in sizes.items() if cpus <= machine.total_cpus)
+        if not sizes:
+            logger.info("Skipping %s because none of the wanted slot sizes fit on it.\n", machine.name)
+            continue
+        machine.free_up_n_cpus = min(sizes.values())
 
-            logger.debug('total killable CPUs    %-4s', machine.total_killable_cpus)
+        #a draining machine is not finished until the size it is draining for is free, while that size is still wanted
+        draining = str(condor_startd["PREEMPTABLE_ONLY"]) == "True"
+        if draining and startd_drain_slot_size(condor_startd) in sizes.values():
+            machine.free_up_n_cpus = startd_drain_slot_size(condor_startd)
 
-            if machine.total_killable_cpus >= free_up_n_cpus:
-                machines_draining_to_stop.append(machine)
+        if machine.total_killable_cpus >= machine.free_up_n_cpus:
+            machines_draining_to_stop.append(machine)
+        else:
+            if draining:
+                machines_are_draining.append(machine)
+                machines_draining += 1
             else:
-                if str(condor_startd["PREEMPTABLE_ONLY"]) == "True":
-                    machines_are_draining.append(machine)
-                    machines_draining += 1
-                else:
-                    machine.rank = (machine.total_cpus - machine.total_killable_cpus) / (free_up_n_cpus - machine.total_killable_cpus)
-                    machines_can_drain.append(machine)
+                busy_cpus = machine.total_cpus - machine.total_killable_cpus
+                for size, free_up_n_cpus in sizes.items():
+                    if size == WHOLE_NODE:
+                        #the rank below is always 1 for a whole node, so take the one with the fewest CPUs to free
+                        key = free_up_n_cpus - machine.total_killable_cpus
+                    else:
+                        key = -busy_cpus / (free_up_n_cpus - machine.total_killable_cpus)
+                    drain_heaps[size].append((key, machine.name, free_up_n_cpus, machine))
+                machine.cost = machine.free_up_n_cpus - machine.total_killable_cpus
+                machine.rank = busy_cpus / machine.cost
+                machines_can_drain.append(machine)
 
     #summary of results
     logger.info('Machines that can be drained')
@@ -383,42 +969,15 @@ def main():
     #
     #---------------------------------------------------------------------------------
 
-    logger.info('Actions taken...')
     # Cancel draining (and kill jobs) of machines which have N or more killable CPUs
     # if a machine stops drainiing because of this, PREEMPT THE PREEMPTABLE JOBS!
     for machine in machines_draining_to_stop:
-        logger.info("Draining finished on %s", machine.name)
-        try:
-            #htcondor.set_subsystem("STARTD")
-            #htcondor.reload_config()
-            #condor_startd = condor_collector.locate(htcondor.DaemonTypes.Startd, "slot1@%(name)s" % machine)
-            #htcondor.RemoteParam(condor_startd)
-
-            kill_this_many = int(max((free_up_n_cpus * int(machine.total_killable_cpus / free_up_n_cpus)) - machine.num_free, 0))
-
-            #kill the newest first, as they will have done the least
-            machine.preemptable_jobs = sorted(machine.preemptable_jobs, key=attrgetter('start_time'), reverse=True)
-            if kill_this_many > 0 and drain:
-                #put node on hold so no new jobs can start while we kill jobs
-                persistent_set(machine.name, "-startd", "StartJobs", "False")
-                logger.info("Killing %i jobs %s", kill_this_many, machine.name)
-                kill_jobs(condor_collector, machine, kill_this_many)
-                time.sleep(10) #give jobs a chance to vacate before unholdin the job
-
-        except IOError:
-            logger.warning("IO Error killing jobs on %s, skipping.", machine.name)
-        except RuntimeError:
-            logger.warning("Runtime Error killing jobs on %s, skipping.", machine.name)
-
-        try:
-            #ensure the machine is in the correct state to run jobs
-            #allow non preemptable jobs to run (if jobs could run)
-            persistent_set(machine.name, "-startd", "PREEMPTABLE_ONLY", "False")
-            #allow jobs to run
-            persistent_set(machine.name, "-startd", "StartJobs", "True")
-        except IOError:
-            logger.critical("Could not get %(name)s back to a suitable state to run jobs!", machine)
-            continue
+        free_up_n_cpus = machine.free_up_n_cpus
+        machine.kill_this_many = int(max((free_up_n_cpus * int(machine.total_killable_cpus / free_up_n_cpus)) - machine.num_free, 0))
+        #kill the newest first, as they will have done the least (preemptable_jobs is already in that order)
+        if machine.kill_this_many > 0 and drain:
+            plan.kills.append(machine)
+    plan.drain_finished = machines_draining_to_stop
 
     #---------------------------------------------------------------------------------
     #
@@ -427,37 +986,261 @@ def main():
     #---------------------------------------------------------------------------------
 
     # if a machine stops draining because of this, we want to keep jobs running
-    for machine in sorted(machines_are_draining, key=attrgetter('total_killable_cpus')):
-        if machines_draining > max_concurrent_draining and machines_draining > 0:
-            try:
-                persistent_set(machine.name, "-startd", "PREEMPTABLE_ONLY", "False")
-                logger.info('CANCEL DRAINING %s %s', machine.name, machine.total_killable_cpus)
-                machines_draining -= 1
-            except IOError:
-                logger.error("Error setting %s to cancel draining, skipping.", machine.name)
+    # cancel the ones that have got the least far first
+    too_many = max(machines_draining - max_concurrent_draining, 0)
+    plan.cancels = heapq.nsmallest(too_many, machines_are_draining, key=attrgetter('total_killable_cpus'))
+
+    # share what is left of the budget between the slot sizes by demand and take the best ranked
+    # machines for each size, then give any share a size could not use to the cheapest of the rest
+    budget = max_concurrent_draining - (machines_draining - len(plan.cancels))
+    chosen = set()
+    for size, share in sorted(share_budget(budget, demand).items(), key=lambda item: str(item[0])):
+        heap = drain_heaps[size]
+        heapq.heapify(heap)
+        while heap and share > 0:
+            _, name, free_up_n_cpus, machine = heapq.heappop(heap)
+            if name in chosen:
                 continue
-        else:
-            break
+            machine.free_up_n_cpus = free_up_n_cpus
+            logger.debug('Drain %s for %s core slots', name, size)
+            plan.drains.append(machine)
+            chosen.add(name)
+            share -= 1
 
+    rest = [machine for machine in machines_can_drain if machine.name not in chosen]
+    plan.drains.extend(heapq.nsmallest(budget - len(plan.drains), rest, key=attrgetter('cost')))
 
-    for machine in sorted(machines_can_drain, key=attrgetter('rank'), reverse=True):
-        if machines_draining < max_concurrent_draining:
-            try:
-                persistent_set(machine.name, "-startd", "PREEMPTABLE_ONLY", "True")
-                logger.info('START DRAINING %s %s', machine.name, machine.rank)
-                machines_draining += 1
-            except IOError:
-                logger.error("Error setting %s to drain, skipping.", machine.name)
+    plan.machines_draining = machines_draining
+    return plan
+
+
+def log_plan(plan):
+    """ Logs the actions in plan without taking them, for --dry-run and --replay"""
+    logger = logging.getLogger('condor_efficient_defrag')
+    logger.info('Actions planned (not taken)...')
+    for machine in plan.drain_finished:
+        logger.info("Draining finished on %s", machine.name)
+    for machine in plan.kills:
+        logger.info("Would kill %i jobs %s: %s", machine.kill_this_many, machine.name,
+                    ' '.join(job.global_id for job in machine.preemptable_jobs[0:machine.kill_this_many]))
+    for machine in plan.cancels:
+        logger.info('Would CANCEL DRAINING %s %s', machine.name, machine.total_killable_cpus)
+    for machine in plan.drains:
+        logger.info('Would START DRAINING %s %s for %i cores', machine.name, machine.rank, machine.free_up_n_cpus)
+
+    machines_draining = plan.machines_draining - len(plan.cancels) + len(plan.drains)
+    if machines_draining != plan.max_concurrent_draining:
+        logger.warning("%i machines would be draining, should be %i", machines_draining, plan.max_concurrent_draining)
+
+
+def execute_plan(plan, condor_collector, schedds):
+    """ Takes the actions in plan: kills jobs, then reconfigures the startds"""
+    logger = logging.getLogger('condor_efficient_defrag')
+
+    #---------------------------------------------------------------------------------
+    #
+    # Kill jobs (and Cancel draining) of machines if they can take a multicore job
+    #
+    #---------------------------------------------------------------------------------
+
+    logger.info('Actions taken...')
+    for machine in plan.drain_finished:
+        logger.info("Draining finished on %s", machine.name)
+
+    with STATS.phase('kill'):
+        #put nodes on hold so no new jobs can start while we kill jobs
+        held = reconfigure_machines(dict((machine.name, [("StartJobs", "False")]) for machine in plan.kills))
+
+        # kill on every machine at once, grouped by schedd, then give them all the same window to vacate
+        machines_held = []
+        jobs_to_kill = []
+        for machine in plan.kills:
+            if not held[machine.name]:
+                STATS.count('errors')
+                logger.warning("Could not put %s on hold, not killing jobs.", machine.name)
+                continue
+            logger.info("Killing %i jobs %s", machine.kill_this_many, machine.name)
+            machines_held.append(machine)
+            jobs_to_kill.extend(machine.preemptable_jobs[0:machine.kill_this_many])
+
+        killed = set(kill_jobs(schedds, jobs_to_kill))
+        STATS.count('jobs_killed', len(killed))
+
+        vacating = dict()
+        deadline = time.time() + VACATE['timeout']
+        for machine in machines_held:
+            vacating[machine.name] = (deadline, set(job.global_id for job in machine.preemptable_jobs[0:machine.kill_this_many]) & killed)
+
+        released = release_after_vacate(condor_collector, vacating)
+
+    #---------------------------------------------------------------------------------
+    #
+    # Cancel Draining or Drain machines if necessary
+    #
+    #---------------------------------------------------------------------------------
+
+    # every change to a machine goes into one batch, so each machine is reconfigured once
+    changes = dict()
+    for machine in plan.drain_finished:
+        if machine.name not in released:
+            changes[machine.name] = RELEASE_SETTINGS
+    for machine in plan.cancels:
+        changes[machine.name] = [("PREEMPTABLE_ONLY", "False")]
+    for machine in plan.drains:
+        changes[machine.name] = [("PREEMPTABLE_ONLY", "True"), (DRAIN_SLOT_SIZE, str(int(machine.free_up_n_cpus)))]
+
+    with STATS.phase('reconfig'):
+        reconfigured = reconfigure_machines(changes)
+    reconfigured.update(released)
+
+    for machine in plan.drain_finished:
+        if not reconfigured[machine.name]:
+            STATS.count('errors')
+            logger.critical("Could not get %s back to a suitable state to run jobs!", machine.name)
+
+    machines_draining = plan.machines_draining
+    for machine in plan.cancels:
+        if reconfigured[machine.name]:
+            logger.info('CANCEL DRAINING %s %s', machine.name, machine.total_killable_cpus)
+            machines_draining -= 1
         else:
-            break
+            STATS.count('errors')
+            logger.error("Error setting %s to cancel draining, skipping.", machine.name)
+
+    for machine in plan.drains:
+        if reconfigured[machine.name]:
+            logger.info('START DRAINING %s %s', machine.name, machine.rank)
+            machines_draining += 1
+        else:
+            STATS.count('errors')
+            logger.error("Error setting %s to drain, skipping.", machine.name)
+
+    if machines_draining != plan.max_concurrent_draining:
+        logger.warning("%i machines draining, should be %i", machines_draining, plan.max_concurrent_draining)
+
+
+def ad_to_dict(ad):
+    """ Converts a ClassAd into a dict that can be written out as JSON"""
+    return dict((key, ad[key]) for key in ad.keys())
+
+
+def save_snapshot(filename, startds, running_jobs, schedd_jobs, reachable, drain):
+    """ Writes the inputs to plan_cycle() to filename as JSON, so they can be used with --replay"""
+    snapshot = {
+        'startds' : [ad_to_dict(startd) for startd in startds],
+        'running_jobs' : dict((machine, [ad_to_dict(job) for job in jobs]) for machine, jobs in running_jobs.items()),
+        'schedd_jobs' : dict((schedd, [ad_to_dict(job) for job in jobs]) for schedd, jobs in schedd_jobs.items()),
+        'reachable' : reachable,
+        'drain' : drain,
+    }
+    with open(filename, 'w') as snapshot_file:
+        #anything that is not plain data, like an unevaluated expression, is written as a string
+        json.dump(snapshot, snapshot_file, default=str)
+
+
+def replay(filename):
+    """ Plans a cycle from a snapshot written by save_snapshot(), without connecting to the pool"""
+    logger = logging.getLogger('condor_efficient_defrag')
+    with open(filename) as snapshot_file:
+        snapshot = json.load(snapshot_file)
+
+    logger.info("Replaying %s: %i startds, %i schedds", filename, len(snapshot['startds']), len(snapshot['schedd_jobs']))
+
+    #machines not probed when the snapshot was taken are taken to be reachable
+    reachable = dict((str(startd["Machine"]), True) for startd in snapshot['startds'] if "Machine" in startd)
+    reachable.update(snapshot.get('reachable') or dict())
+
+    plan = plan_cycle(snapshot['startds'], snapshot['running_jobs'], snapshot['schedd_jobs'], reachable, snapshot.get('drain', True))
+    log_plan(plan)
+    return plan
+
+
+def run_cycle(pool, dry_run=False, snapshot_filename=None, prometheus_filename=None):
+    """ Runs one defrag cycle, refreshing pool first. With dry_run the plan is only logged.
+    Stats for the cycle are logged, and written to prometheus_filename if given, even if the cycle fails"""
+    logger = logging.getLogger('condor_efficient_defrag')
+
+    logger.info("Starting run at: %s", datetime.datetime.now())
+    STATS.reset()
 
-    if machines_draining != max_concurrent_draining:
-        logger.warning("%i machines draining, should be %i", machines_draining, max_concurrent_draining)
+    #if not create_lock():
+    #    sys.exit(1)
+
+    try:
+        with STATS.phase('collect'):
+            pool.refresh()
+            condor_stards = list(pool.startds.values())
+
+            # Get jobs from as many schedds as possible
+            schedd_jobs = get_all_schedd_jobs(pool.schedds, pool.schedd_hosts)
+
+        #can we contact the machines, all probed at once
+        with STATS.phase('probe'):
+            candidates = [str(condor_startd["Machine"]) for condor_startd in condor_stards if startd_is_candidate(condor_startd)]
+            reachable = probe_reachability(candidates)
+
+        drain = not os.path.isfile(FILENAME_INHIBIT_DRAINING)
+
+        if snapshot_filename:
+            save_snapshot(snapshot_filename, condor_stards, pool.running_jobs, schedd_jobs, reachable, drain)
+            logger.info("Saved snapshot to %s", snapshot_filename)
+
+        with STATS.phase('plan'):
+            plan = plan_cycle(condor_stards, pool.running_jobs, schedd_jobs, reachable, drain)
+
+        STATS.count('nodes_candidate', len(reachable))
+        STATS.count('nodes_unreachable', len([hostname for hostname in reachable if reachable[hostname] is False]))
+        STATS.count('nodes_unknown', len([hostname for hostname in reachable if reachable[hostname] is None]))
+        STATS.count('nodes_draining', plan.machines_draining)
+        STATS.count('nodes_drain_finished', len(plan.drain_finished))
+        STATS.count('nodes_kill', len(plan.kills))
+        STATS.count('nodes_cancel', len(plan.cancels))
+        STATS.count('nodes_drain', len(plan.drains))
+
+        if dry_run:
+            log_plan(plan)
+        else:
+            execute_plan(plan, pool.condor_collector, pool.schedds)
+    except (Exception, SystemExit):
+        STATS.count('errors')
+        raise
+    finally:
+        logger.info("Cycle stats: %s", json.dumps(STATS.summary(), sort_keys=True))
+        if prometheus_filename:
+            try:
+                STATS.write_prometheus(prometheus_filename)
+            except (IOError, OSError) as error:
+                logger.error("Could not write stats to %s: %s", prometheus_filename, error)
 
     logger.info("Ending run at: %s", datetime.datetime.now())
 
 
-if __name__ == "__main__":
+def main(argv=None):
+    """ Main function, called when module is run as a CLI application """
+    parser = argparse.ArgumentParser(description='Drain worker nodes for multicore jobs, preempting preemptable jobs.')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running, with one cycle every --interval seconds, instead of a single run')
+    parser.add_argument('--interval', type=int, default=DAEMON['interval'],
+                        help='seconds between the start of each cycle in daemon mode (default: %(default)s)')
+    parser.add_argument('--full-refresh-cycles', type=int, default=DAEMON['full_refresh_cycles'],
+                        help='re-read the whole pool every this many cycles in daemon mode (default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='work out and log what would be done, without killing jobs or reconfiguring startds')
+    parser.add_argument('--save-snapshot', metavar='SNAPSHOT_JSON',
+                        help='save the ads each cycle is planned from, for use with --replay')
+    parser.add_argument('--replay', metavar='SNAPSHOT_JSON',
+                        help='plan a cycle from a saved snapshot and log it, without connecting to HTCondor')
+    parser.add_argument('--prometheus-textfile', metavar='PROM_FILE',
+                        help='write timings and counters for each cycle to this file, for the node exporter textfile collector')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s')
+    logger = logging.getLogger('condor_efficient_defrag')
+    logger.setLevel(logging.INFO)
+
+    if args.replay:
+        replay(args.replay)
+        return
 
     fp = open(FILENAME_MULTI_RUN_LOCK, 'w')
 
@@ -467,4 +1250,26 @@ if __name__ == "__main__":
         print "Defrag script is already running but has been called again (%s locked)." % FILENAME_MULTI_RUN_LOCK
         sys.exit(1)
 
+    if htcondor is None:
+        logger.error("The htcondor python bindings are needed unless using --replay, exiting.")
+        sys.exit(1)
+
+    pool = PoolModel(get_collector(), args.full_refresh_cycles)
+
+    if not args.daemon:
+        run_cycle(pool, args.dry_run, args.save_snapshot, args.prometheus_textfile)
+        return
+
+    while True:
+        cycle_start = time.time()
+        try:
+            run_cycle(pool, args.dry_run, args.save_snapshot, args.prometheus_textfile)
+        except (Exception, SystemExit) as error:
+            #anything that would end a single run only ends this cycle
+            logger.error("Cycle failed (%s: %s), doing a full refresh next cycle.", type(error).__name__, error)
+            pool.invalidate()
+        time.sleep(max(args.interval - (time.time() - cycle_start), 0))
+
+
+if __name__ == "__main__":
     main()
@@ -0,0 +1,229 @@
+"""An in-process stand-in for the parts of the htcondor python bindings that
+efficientdefrag.py uses, backed by a synthetic pool.
+
+It only understands the constraints that efficientdefrag.py sends, and it counts
+every round trip so benchmarks can report how many a cycle makes.
+Install it with sys.modules['htcondor'] = fake_htcondor before importing efficientdefrag."""
+
+import random
+import re
+import threading
+import time
+
+
+class AdTypes(object):
+    Startd = 'Startd'
+    Schedd = 'Schedd'
+
+
+class DaemonTypes(object):
+    Collector = 'Collector'
+    Schedd = 'Schedd'
+    Startd = 'Startd'
+
+
+class JobAction(object):
+    Remove = 'Remove'
+
+
+STATS = dict()
+STATS_LOCK = threading.Lock()
+
+# Seconds added to every collector and schedd round trip
+LATENCY = {
+    'collector' : 0.0,
+    'schedd' : 0.0,
+}
+
+
+def reset_stats():
+    """ Zeroes the round trip counters"""
+    with STATS_LOCK:
+        for key in ('collector_queries', 'collector_locates', 'schedd_queries', 'schedd_acts', 'ads_returned'):
+            STATS[key] = 0
+
+
+def count(key, latency, ads=0):
+    """ Records a round trip and waits for the simulated latency"""
+    with STATS_LOCK:
+        STATS[key] += 1
+        STATS['ads_returned'] += ads
+    if latency:
+        time.sleep(latency)
+
+
+reset_stats()
+
+
+class SyntheticPool(object):
+    """ A randomly generated pool of partitionable worker nodes, their running jobs and the schedds' queues """
+
+    def __init__(self, nodes, preemptable_fraction=0.3, draining_fraction=0.05, schedds=12, idle_multicore=500, seed=1,
+                 update_interval=300):
+        rnd = random.Random(seed)
+        self.random = rnd
+        # Seconds between the updates every startd sends the collector, as UPDATE_INTERVAL
+        self.update_interval = update_interval
+        self.schedd_names = ['arc-ce%02i.gridpp.rl.ac.uk' % i for i in range(schedds)]
+        self.startds = []
+        self.slots = dict()
+        self.jobs = dict((name, dict()) for name in self.schedd_names)
+        self.job_machines = dict()
+        heard = int(time.time()) - 1000
+
+        cluster = 0
+        for node in range(nodes):
+            machine = 'lcg%05i.gridpp.rl.ac.uk' % node
+            total_cpus = rnd.choice([16, 32, 48, 64])
+            used = 0
+            self.slots[machine] = []
+            while True:
+                cpus = 8 if rnd.random() < 0.3 else 1
+                if used + cpus > total_cpus or rnd.random() < 0.02:
+                    break
+                used += cpus
+                cluster += 1
+                schedd = rnd.choice(self.schedd_names)
+                job_id = '%i.0' % cluster
+                global_id = '%s#%s#%i' % (schedd, job_id, heard)
+                preemptable = cpus == 1 and rnd.random() < preemptable_fraction
+                start_time = heard - rnd.randint(0, 86400)
+                self.slots[machine].append({
+                    'Name' : 'slot1_%i@%s' % (len(self.slots[machine]) + 1, machine),
+                    'Machine' : machine,
+                    'JobId' : job_id,
+                    'GlobalJobId' : global_id,
+                    'ClientMachine' : schedd,
+                    'EnteredCurrentActivity' : start_time,
+                    'Cpus' : cpus,
+                    'DynamicSlot' : True,
+                    'LastHeardFrom' : heard,
+                })
+                self.job_machines[global_id] = machine
+                self.jobs[schedd][job_id] = {
+                    'GlobalJobId' : global_id,
+                    'JobStatus' : 2,
+                    'RequestCpus' : cpus,
+                    'isPreemptable' : preemptable,
+                    'JobCurrentStartDate' : start_time,
+                }
+
+            self.startds.append({
+                'Name' : 'slot1@%s' % machine,
+                'Machine' : machine,
+                'PartitionableSlot' : True,
+                'PREEMPTABLE_ONLY' : rnd.random() < draining_fraction,
+                'NODE_IS_HEALTHY' : True,
+                'StartJobs' : True,
+                'TotalCpus' : total_cpus,
+                'Cpus' : total_cpus - used,
+                'LastHeardFrom' : heard,
+            })
+
+        for job in range(idle_multicore):
+            cluster += 1
+            schedd = rnd.choice(self.schedd_names)
+            self.jobs[schedd]['%i.0' % cluster] = {
+                'GlobalJobId' : '%s#%i.0#%i' % (schedd, cluster, heard),
+                'JobStatus' : 1,
+                'RequestCpus' : 8,
+                'isPreemptable' : False,
+            }
+
+    def touch(self, fraction):
+        """ Marks a fraction of the machines as having just updated the collector, as churn between cycles"""
+        now = int(time.time())
+        for startd in self.random.sample(self.startds, int(len(self.startds) * fraction)):
+            startd['LastHeardFrom'] = now
+            for slot in self.slots[startd['Machine']]:
+                slot['LastHeardFrom'] = now
+
+    def heartbeat(self, interval):
+        """ Marks the machines that would have sent their periodic update in the last interval seconds as having
+        just updated the collector. Startds send it every update_interval seconds, whether anything changed or not"""
+        self.touch(min(float(interval) / self.update_interval, 1.0))
+
+    def remove_jobs(self, schedd, job_ids):
+        """ Removes jobs from a schedd's queue and frees their slots"""
+        removed = set()
+        for job_id in job_ids:
+            job = self.jobs[schedd].pop(job_id, None)
+            if job:
+                removed.add(job['GlobalJobId'])
+        for machine in set(self.job_machines.pop(global_id) for global_id in removed):
+            self.slots[machine] = [slot for slot in self.slots[machine] if slot['GlobalJobId'] not in removed]
+
+
+POOL = None
+
+
+def use_pool(pool):
+    """ Makes Collector and Schedd answer from pool"""
+    global POOL
+    POOL = pool
+
+
+def project(ads, projection):
+    """ Returns copies of ads with only the attributes in projection, as the collector would"""
+    if not projection:
+        return [dict(ad) for ad in ads]
+    return [dict((key, ad[key]) for key in projection if key in ad) for ad in ads]
+
+
+def since(constraint):
+    """ Returns the LastHeardFrom lower bound in constraint, or None"""
+    match = re.search(r'LastHeardFrom >= (\d+)', constraint)
+    if match:
+        return int(match.group(1))
+    return None
+
+
+class Collector(object):
+    """ Answers the collector queries that efficientdefrag.py makes"""
+
+    def __init__(self, hostname=None):
+        self.hostname = hostname
+
+    def locateAll(self, daemon_type):
+        count('collector_locates', LATENCY['collector'])
+        return [{'Name' : self.hostname}]
+
+    def locate(self, daemon_type, name):
+        count('collector_locates', LATENCY['collector'])
+        return {'Name' : name}
+
+    def query(self, ad_type, constraint="", projection=None):
+        if ad_type == AdTypes.Schedd:
+            ads = [{'Name' : name} for name in POOL.schedd_names]
+        elif 'JobId =!= UNDEFINED' in constraint:
+            machines = re.findall(r'Machine=="([^"]*)"', constraint)
+            if not machines:
+                machines = POOL.slots.keys()
+            ads = [slot for machine in machines for slot in POOL.slots.get(machine, [])]
+        elif 'PartitionableSlot =?= True' in constraint:
+            ads = POOL.startds
+        else:
+            ads = POOL.startds + [slot for slots in POOL.slots.values() for slot in slots]
+        heard_since = since(constraint)
+        if heard_since is not None:
+            ads = [ad for ad in ads if ad['LastHeardFrom'] >= heard_since]
+        ads = project(ads, projection)
+        count('collector_queries', LATENCY['collector'], len(ads))
+        return ads
+
+
+class Schedd(object):
+    """ Answers the schedd queries and actions that efficientdefrag.py makes"""
+
+    def __init__(self, location_ad=None):
+        self.name = location_ad['Name']
+
+    def query(self, constraint="", projection=None):
+        jobs = [job for job in POOL.jobs[self.name].values() if job['RequestCpus'] > 1 or job['isPreemptable']]
+        jobs = project(jobs, projection)
+        count('schedd_queries', LATENCY['schedd'], len(jobs))
+        return jobs
+
+    def act(self, action, job_spec):
+        count('schedd_acts', LATENCY['schedd'])
+        POOL.remove_jobs(self.name, job_spec)
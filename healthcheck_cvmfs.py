@@ -0,0 +1,211 @@
+"""
+CernVM-FS repository probes for healthcheck_wn_condor.
+
+This makes the checks check_cvmfs2.sh makes by default, reading the repository's
+extended attributes directly instead of running attr, df and friends for each one.
+probe() returns the status check_cvmfs2.sh would exit with and its message.
+It can block for as long as the repository does, so run it under a deadline.
+"""
+
+import glob
+import os
+import subprocess
+import threading
+import time
+
+STATUS_OK = 0
+STATUS_WARNING = 1 # Resource consumption high or a previous error detected
+STATUS_CRITICAL = 2 # CernVM-FS not working
+STATUS_UNKNOWN = 3 # Internal error
+
+CONFIG_DIR = '/etc/cvmfs'
+CVMFS2 = '/usr/bin/cvmfs2'
+
+# The thresholds check_cvmfs2.sh uses by default
+LIMITS = {
+    'max_fill_ratio' : 95, # percent of the cache partition used
+    'io_error_period' : 180, # minutes after which I/O errors are ignored
+    'max_fd_ratio' : 80, # percent of the file descriptors open
+    'max_cleanups' : 24, # cache cleanups in the last 24 hours
+}
+
+installed_version_lock = threading.Lock()
+installed_version = []
+
+
+class ProbeError(Exception):
+    """
+    A probe that can't go any further, with the status to report
+    """
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def sanitize_version(version):
+    """
+    Make a version in the format RELEASE.MAJOR.MINOR.PATCH
+    """
+    return version + '.0' * max(3 - version.count('.'), 0)
+
+def get_installed_version():
+    """
+    The version of cvmfs2 installed. It is the same for every repository, so it is only asked for once.
+    """
+    with installed_version_lock:
+        if not installed_version:
+            try:
+                output = subprocess.check_output([CVMFS2, '--version'], stdin=subprocess.DEVNULL,
+                                                 stderr=subprocess.STDOUT, timeout=30)
+            except subprocess.CalledProcessError as e:
+                output = e.output
+            except (OSError, subprocess.TimeoutExpired):
+                output = b''
+            fields = output.decode(errors='replace').split()
+            installed_version.append(sanitize_version(fields[2] if len(fields) > 2 else ''))
+        return installed_version[0]
+
+def read_config_file(filename, config):
+    """
+    Add the variables set in a CernVM-FS configuration file to config
+    """
+    try:
+        with open(filename) as f:
+            lines = f.readlines()
+    except OSError:
+        return
+    for line in lines:
+        line = line.split('#')[0].strip()
+        if line.startswith('export '):
+            line = line[len('export '):].strip()
+        name, equals, value = line.partition('=')
+        if equals and name.isidentifier():
+            config[name] = value.strip().strip('"\'')
+
+def read_config(repository):
+    """
+    Read the configuration of a repository, in the order cvmfs_readconfig does.
+    Returns its fully qualified name and the configuration.
+    """
+    default_config = os.path.join(CONFIG_DIR, 'default.conf')
+    if not os.path.isfile(default_config):
+        raise ProbeError(STATUS_UNKNOWN, '%s missing' % default_config)
+    config = {'CVMFS_MOUNT_DIR' : '/cvmfs', 'CVMFS_CACHE_BASE' : '/var/lib/cvmfs', 'CVMFS_DEFAULT_DOMAIN' : 'cern.ch'}
+    filenames = [default_config] + sorted(glob.glob(os.path.join(CONFIG_DIR, 'default.d', '*.conf')))
+    filenames.append(os.path.join(CONFIG_DIR, 'default.local'))
+    for filename in filenames:
+        read_config_file(filename, config)
+
+    fqrn = repository if '.' in repository else '%s.%s' % (repository, config['CVMFS_DEFAULT_DOMAIN'])
+    domain = fqrn.split('.', 1)[1]
+    for filename in ['domain.d/%s.conf' % domain, 'domain.d/%s.local' % domain,
+                     'config.d/%s.conf' % fqrn, 'config.d/%s.local' % fqrn]:
+        read_config_file(os.path.join(CONFIG_DIR, filename), config)
+    return fqrn, config
+
+def get_xattr(path, name, default=None):
+    """
+    Read one of the extended attributes cvmfs2 serves for a repository.
+    Without a default, not being able to read it ends the probe.
+    """
+    try:
+        return os.getxattr(path, 'user.%s' % name).decode(errors='replace').strip()
+    except OSError:
+        if default is None:
+            raise ProbeError(STATUS_UNKNOWN, 'failed to read %s attribute' % name)
+        return default
+
+def get_int_xattr(path, name, default=None):
+    try:
+        return int(get_xattr(path, name, default))
+    except ValueError:
+        raise ProbeError(STATUS_UNKNOWN, 'failed to read %s attribute' % name)
+
+def check_repository(repository):
+    """
+    The checks, returning the status and the problems found. This can hang if cvmfs hangs.
+    """
+    fqrn, config = read_config(repository)
+
+    # Grab mountpoint / basic availability
+    path = os.path.join(config['CVMFS_MOUNT_DIR'], fqrn)
+    try:
+        os.listdir(path)
+    except OSError:
+        raise ProbeError(STATUS_CRITICAL, 'failed to access %s' % fqrn)
+
+    # Gather usage information from cvmfs
+    version_loaded = sanitize_version(get_xattr(path, 'version'))
+    nioerr = get_int_xattr(path, 'nioerr')
+    nfduse = get_int_xattr(path, 'usedfd')
+    nfdmax = get_int_xattr(path, 'maxfd')
+    ncatalogs = get_int_xattr(path, 'nclg')
+    revision = get_xattr(path, 'revision')
+    # Added in cvmfs 2.4, -1 means the cleanup rate isn't known
+    ncleanup24 = get_int_xattr(path, 'ncleanup24', '-1')
+    # Added in cvmfs 2.9, 0 means the time of the last I/O error isn't known
+    timestamp_last_ioerr = get_int_xattr(path, 'timestamp_last_ioerr', '0')
+
+    problems = []
+    status = STATUS_OK
+
+    version_installed = get_installed_version()
+    if version_installed != version_loaded:
+        problems.append('version mismatch (loaded %s, installed %s)' % (version_loaded, version_installed))
+        status = STATUS_WARNING
+
+    # Check for previously detected I/O errors
+    if nioerr > 0:
+        period = LIMITS['io_error_period']
+        if not (timestamp_last_ioerr > 0 and period > 0 and (time.time() - timestamp_last_ioerr) // 60 > period):
+            problems.append('%d I/O errors detected' % nioerr)
+            status = STATUS_WARNING
+
+    # Check for number of open file descriptors
+    fd_ratio = nfduse * 100 // nfdmax if nfdmax > 0 else 100
+    if fd_ratio > LIMITS['max_fd_ratio']:
+        problems.append('low on open file descriptors (%d%%)' % fd_ratio)
+        status = STATUS_WARNING
+
+    # Check for number of loaded catalogs (< 10% of FDMAX?)
+    if ncatalogs * 10 > nfdmax:
+        problems.append('high no. loaded catalogs (%d)' % ncatalogs)
+        status = STATUS_WARNING
+
+    # Check for free space on cache partition, rounded up as df does
+    try:
+        cache = os.statvfs(config['CVMFS_CACHE_BASE'])
+        used = cache.f_blocks - cache.f_bfree
+        available = used + cache.f_bavail
+        fill_ratio = -(-used * 100 // available) if available else 0
+        if fill_ratio > LIMITS['max_fill_ratio']:
+            problems.append('space on cache partition low')
+            status = STATUS_WARNING
+    except OSError:
+        problems.append('failed to stat %s' % config['CVMFS_CACHE_BASE'])
+        status = STATUS_CRITICAL
+
+    # Check for number of cache cleanups within the last 24 hours
+    if ncleanup24 > LIMITS['max_cleanups']:
+        problems.append('frequent cache cleanups, cache might be undersized')
+        status = STATUS_WARNING
+
+    dirtab = os.path.join(path, '.cvmfsdirtab')
+    if os.path.isfile(dirtab):
+        try:
+            with open(dirtab, 'rb') as f:
+                f.read()
+        except OSError:
+            problems.append('failed to read .cvmfsdirtab from repository')
+            status = STATUS_CRITICAL
+
+    return status, '%s; repository revision %s' % ('; '.join(problems) or 'OK', revision)
+
+def probe(repository):
+    """
+    Probe a repository. Returns the status and message check_cvmfs2.sh would have given.
+    """
+    try:
+        return check_repository(repository)
+    except ProbeError as e:
+        return e.status, str(e)
@@ -0,0 +1,169 @@
+"""
+Filesystem probes for healthcheck_wn_condor.
+
+The mount table is read from /proc/self/mountinfo, free space comes from statvfs
+and the XFS format from the geometry ioctl xfs_info uses, so no df, check_disk,
+xfs_info or mountpoint processes are needed. Anything that touches a filesystem
+can hang with it, so those probes are run with guarded() or with_timeout().
+"""
+
+import errno
+import fcntl
+import os
+import re
+import struct
+import threading
+from concurrent.futures import Future, TimeoutError
+
+MOUNTINFO = '/proc/self/mountinfo'
+
+# struct xfs_fsop_geom is 112 bytes, with the flags at the same offset in v1 and v4.
+# Kernels before 5.1 only know the v1 request.
+XFS_IOC_FSGEOMETRY_V4 = 0x8070587C
+XFS_IOC_FSGEOMETRY_V1 = 0x80705864
+XFS_GEOMETRY_SIZE = 112
+XFS_GEOMETRY_FLAGS_OFFSET = 92
+XFS_FSOP_GEOM_FLAGS_FTYPE = 0x10000
+
+MB = 1024 * 1024
+
+
+class ProbeTimeout(Exception):
+    pass
+
+
+class Mount(object):
+    """
+    One line of /proc/self/mountinfo
+    """
+    def __init__(self, device, mount_point, fstype, source):
+        self.device = device
+        self.mount_point = mount_point
+        self.fstype = fstype
+        self.source = source
+
+
+class Space(object):
+    """
+    The space free on a filesystem, as check_disk counts it: what is available to users
+    """
+    def __init__(self, path):
+        stat = os.statvfs(path)
+        used = stat.f_blocks - stat.f_bfree
+        total = used + stat.f_bavail
+        self.free_mb = stat.f_bavail * stat.f_frsize / MB
+        # df rounds the percentage used up
+        self.free_percent = 100 - (-(-used * 100 // total)) if total else 100
+
+
+def unescape(field):
+    """
+    mountinfo escapes spaces, tabs, newlines and backslashes in paths as octal
+    """
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+def read_mounts(filename=MOUNTINFO):
+    """
+    The mounts this process can see, in the order they were mounted
+    """
+    mounts = []
+    try:
+        with open(filename) as f:
+            lines = f.readlines()
+    except OSError:
+        return mounts
+    for line in lines:
+        fields = line.split()
+        if '-' not in fields:
+            continue
+        separator = fields.index('-')
+        mounts.append(Mount(fields[2], unescape(fields[4]), fields[separator + 1], unescape(fields[separator + 2])))
+    return mounts
+
+def is_mountpoint(path, mounts):
+    path = os.path.realpath(path)
+    return any(mount.mount_point == path for mount in mounts)
+
+def find_mount(path, mounts):
+    """
+    The mount path is on, as df --output=target would say. Later mounts hide earlier ones.
+    """
+    path = os.path.realpath(path)
+    found = None
+    for mount in mounts:
+        prefix = mount.mount_point.rstrip('/') + '/'
+        if (path == mount.mount_point or path.startswith(prefix)) and \
+           (found is None or len(mount.mount_point) >= len(found.mount_point)):
+            found = mount
+    return found
+
+def local_filesystems(mounts):
+    """
+    The block device filesystems df -l -x fuse lists. A device mounted in more than one place
+    is only listed once, at its shortest mount point, as df does.
+    """
+    filesystems = {}
+    for mount in mounts:
+        if not mount.source.startswith('/dev') or mount.fstype == 'fuse':
+            continue
+        listed = filesystems.get(mount.device)
+        if listed is None or len(mount.mount_point) < len(listed.mount_point):
+            filesystems[mount.device] = mount
+    return sorted(filesystems.values(), key=mounts.index)
+
+def xfs_ftype(path):
+    """
+    Whether the XFS filesystem path is on records file types in directory entries (ftype=1).
+    None if it isn't XFS.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        for request in (XFS_IOC_FSGEOMETRY_V4, XFS_IOC_FSGEOMETRY_V1):
+            geometry = bytearray(XFS_GEOMETRY_SIZE)
+            try:
+                fcntl.ioctl(fd, request, geometry)
+            except OSError as e:
+                if e.errno in (errno.ENOTTY, errno.EINVAL, errno.EOPNOTSUPP):
+                    continue
+                raise
+            flags, = struct.unpack_from('=I', geometry, XFS_GEOMETRY_FLAGS_OFFSET)
+            return bool(flags & XFS_FSOP_GEOM_FLAGS_FTYPE)
+        return None
+    finally:
+        os.close(fd)
+
+def write_test(filename):
+    """
+    Create and remove filename, as touch and rm -f would. Raises OSError if it can't be created.
+    """
+    os.close(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_NOCTTY | os.O_NONBLOCK, 0o666))
+    try:
+        os.unlink(filename)
+    except OSError:
+        pass
+
+def guarded(function, *args):
+    """
+    Start function in a thread of its own, so a hung filesystem only holds up that thread.
+    Returns a Future for its result.
+    """
+    future = Future()
+    def run():
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+def wait(future, timeout):
+    """
+    The result of a guarded probe, raising ProbeTimeout if it takes longer than timeout seconds
+    """
+    try:
+        return future.result(timeout=max(timeout, 0))
+    except TimeoutError:
+        raise ProbeTimeout('timed out after %gs' % timeout)
+
+def with_timeout(timeout, function, *args):
+    return wait(guarded(function, *args), timeout)
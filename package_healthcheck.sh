@@ -16,5 +16,8 @@ fpm \
     --vendor 'Science and Technology Facilties Council' \
     --url 'https://github.com/stfc/ral-htcondor-tools' \
     --description 'Scripts and stuff used on workernodes with HTCondor at RAL' \
+    --depends 'python3' \
     healthcheck_wn_condor \
+    healthcheck_cvmfs.py \
+    healthcheck_fs.py \
     check_cvmfs2.sh
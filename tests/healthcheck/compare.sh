@@ -0,0 +1,157 @@
+#!/bin/bash
+#
+# Compare the output and exit code of two versions of healthcheck_wn_condor,
+# by default the bash script and the Python rewrite that replaced it, with and
+# without -d, in the failure scenarios below.
+#
+# The system commands and nagios plugins the scripts call are replaced with the
+# fakes in fakes/, and the absolute paths in both scripts are rewritten to a
+# scratch directory, so this needs neither root nor a worker node. Each fake
+# fails as told by the words in $FAIL, see the fakes for what they respond to.
+#
+# usage: compare.sh [OLD_SCRIPT NEW_SCRIPT]
+#
+# Later versions probe CVMFS and the filesystems in-process, which these fakes
+# can't stand in for, so only scripts that call the plugins compare cleanly.
+# The xfshang scenario waits for the 60s xfs_info timeout, so a full run takes
+# several minutes. Exits 1 if any scenario differs.
+
+HERE=$(cd "$(dirname "$0")" && pwd)
+PYTHON=${PYTHON:-python3}
+
+SCENARIOS=(
+    ""
+    "uptime"
+    "nopassword"
+    "check_ntp_time"
+    "mountpoint"
+    "xfsftype"
+    "xfshang"
+    "check_swap"
+    "grid.cern.ch"
+    "cvmfsslow"
+    "disk:POOL"
+    "disk:/"
+    "disk:/ disk:/boot"
+    "disk:/ cms.cern.ch"
+    "dockerps"
+    "containerd"
+    "dockerrun"
+    "dockerrun lhcb.cern.ch"
+    "missing:xrootd-gateway"
+    "unhealthy:xrootd-proxy"
+    "unhealthy:xrootd-gateway lhcb.cern.ch"
+    "missing:xrootd-gateway missing:xrootd-proxy"
+    "cms.cern.ch"
+    "cms.cern.ch atlas.cern.ch"
+    "atlas.cern.ch atlas-condb.cern.ch"
+    "lhcb.cern.ch alice.cern.ch cms.cern.ch"
+    "nodocker"
+    "nodocker cgroup"
+    "nodocker cgroup cgconfig"
+    "virtual"
+)
+
+# Runs that are meant to differ. In debug mode the bash script goes on past a hung
+# xfs_info to run it again without a timeout, and only finishes if it returns;
+# the Python version gives up at the check's deadline.
+KNOWN=(
+    "-d [xfshang]"
+)
+
+ROOT=$(mktemp -d)
+trap 'rm -rf "$ROOT"' EXIT
+
+if [ $# -eq 2 ]
+then
+    cp "$1" "$ROOT/old.in"
+    cp "$2" "$ROOT/new.in"
+    cp "$(dirname "$2")"/healthcheck_*.py "$ROOT/" 2>/dev/null
+elif [ $# -eq 0 ]
+then
+    # The commit that turned the script into Python, and the bash script before it
+    cd "$HERE" || exit 2
+    REV=$(git log --format=%H -S'#!/usr/bin/env python3' -- ../../healthcheck_wn_condor | tail -n 1)
+    if [ -z "$REV" ]
+    then
+        echo "Can't find the Python rewrite of healthcheck_wn_condor in git" >&2
+        exit 2
+    fi
+    git show "$REV^:healthcheck_wn_condor" > "$ROOT/old.in"
+    git show "$REV:healthcheck_wn_condor" > "$ROOT/new.in"
+    cd - > /dev/null
+else
+    echo "usage: $0 [OLD_SCRIPT NEW_SCRIPT]" >&2
+    exit 2
+fi
+
+mkdir -p "$ROOT/bin" "$ROOT/plugins" "$ROOT/docker" "$ROOT/pool/condor" "$ROOT/old" "$ROOT/new"
+cp "$HERE"/fakes/* "$ROOT/bin/"
+mv "$ROOT/bin/check_disk" "$ROOT/bin/check_ntp_time" "$ROOT/bin/check_swap" "$ROOT/plugins/"
+mv "$ROOT/bin/docker" "$ROOT/docker/"
+cp "$ROOT/docker/docker" "$ROOT/docker.fake"
+
+# /pool first, so the paths that replace the others aren't rewritten again
+for version in old new
+do
+    sed -e "s#/pool\b#$ROOT/pool#g" \
+        -e "s#/usr/lib64/nagios/plugins#$ROOT/plugins#g" \
+        -e "s#/usr/local/bin/check_cvmfs2.sh#$ROOT/bin/check_cvmfs2.sh#g" \
+        -e "s#/usr/sbin/xfs_info#$ROOT/bin/xfs_info#g" \
+        -e "s#/usr/bin/docker#$ROOT/docker/docker#g" \
+        -e "s#/sbin/service#$ROOT/bin/service#g" \
+        -e "s#/etc/condor/pool_password#$ROOT/pool_password#g" \
+        -e "s#/proc/uptime#$ROOT/uptime#g" \
+        -e "s#http://169.254.169.254/openstack/latest/meta_data.json#file://$ROOT/meta_data.json#g" \
+        "$ROOT/$version.in" > "$ROOT/$version/healthcheck_wn_condor"
+    chmod +x "$ROOT/$version/healthcheck_wn_condor"
+done
+cp "$ROOT"/healthcheck_*.py "$ROOT/new/" 2>/dev/null
+
+export HC_ROOT=$ROOT
+export PATH=$ROOT/bin:$PATH
+
+setup() {
+    rm -f "$ROOT/pool_password" "$ROOT/meta_data.json" "$ROOT/docker/docker"
+    [[ " $FAIL " == *" nopassword "* ]] || echo secret > "$ROOT/pool_password"
+    [[ " $FAIL " == *" virtual "* ]] && echo '{}' > "$ROOT/meta_data.json"
+    [[ " $FAIL " == *" nodocker "* ]] || cp "$ROOT/docker.fake" "$ROOT/docker/docker"
+    if [[ " $FAIL " == *" uptime "* ]]
+    then
+        echo "300.00 1200.00" > "$ROOT/uptime"
+    else
+        echo "2700.00 5400.00" > "$ROOT/uptime"
+    fi
+}
+
+failures=0
+for scenario in "${SCENARIOS[@]}"
+do
+    for args in "" "-d"
+    do
+        export FAIL=${scenario//POOL/$ROOT/pool}
+        setup
+        bash "$ROOT/old/healthcheck_wn_condor" $args > "$ROOT/old.out" 2>/dev/null
+        old_rc=$?
+        setup
+        $PYTHON "$ROOT/new/healthcheck_wn_condor" $args > "$ROOT/new.out" 2>"$ROOT/new.err"
+        new_rc=$?
+        # the time each run started is the only output allowed to differ
+        sed -i -e 's/^\(DEBUG: starting .* on \).*/\1DATE/' "$ROOT/old.out" "$ROOT/new.out"
+        if cmp -s "$ROOT/old.out" "$ROOT/new.out" && [ $old_rc -eq $new_rc ]
+        then
+            echo "SAME rc=$old_rc $args [$scenario]"
+        elif [[ " ${KNOWN[*]} " == *" $args [$scenario] "* ]]
+        then
+            echo "KNOWN rc=$old_rc/$new_rc $args [$scenario]"
+        else
+            echo "DIFF rc=$old_rc/$new_rc $args [$scenario]"
+            diff "$ROOT/old.out" "$ROOT/new.out"
+            cat "$ROOT/new.err"
+            failures=$((failures + 1))
+        fi
+    done
+done
+
+echo "$failures of $((${#SCENARIOS[@]} * 2)) runs differ"
+[ $failures -eq 0 ]
@@ -0,0 +1,6 @@
+#!/bin/bash
+# Fails for a repository named in $FAIL, and is slow for "cvmfsslow"
+echo "CVMFS $1"
+[[ " $FAIL " == *" $1 "* ]] && exit 2
+[[ " $FAIL " == *" cvmfsslow "* ]] && sleep 1
+exit 0
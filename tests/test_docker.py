@@ -0,0 +1,348 @@
+"""
+Tests for the Engine API backend of docker.py, against a fake dockerd on a unix socket.
+Run with python3 -m unittest discover tests
+"""
+
+import http.server
+import importlib.util
+import json
+import os
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+CACHE_DIR = tempfile.mkdtemp(prefix='docker-wrapper-test-')
+os.environ['DOCKER_WRAPPER_CACHE_DIR'] = CACHE_DIR
+os.environ['DOCKER_WRAPPER_POLICY'] = os.path.join(CACHE_DIR, 'no-policy.json')
+
+# docker.py is a script, not a package, and its name is taken by the docker SDK
+spec = importlib.util.spec_from_file_location('docker_wrapper', os.path.join(os.path.dirname(__file__), '..', 'docker.py'))
+docker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(docker)
+
+IDENTITY = {
+    'interface': 'eth0',
+    'ipv6': '2001:db8:1:2::',
+    'hostname': 'lcg0001',
+    'fqdn': 'lcg0001.gridpp.rl.ac.uk',
+}
+
+
+class FakeDockerd(object):
+    """
+    Answers Engine API requests on a unix socket and records them
+    """
+    def __init__(self, path):
+        self.path = path
+        self.requests = []
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def record(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length).decode()) if length else None
+                fake.requests.append((self.command, self.path, body, id(self.connection)))
+                return body
+
+            def send(self, status, body=b''):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self.record()
+                if body['Image'] == 'missing':
+                    return self.send(404, b'{"message":"No such image: missing:latest"}')
+                if body['Image'] == 'conflict':
+                    return self.send(409, b'{"message":"Conflict. The container name is already in use"}')
+                self.send(201, b'{"Id":"c0ffee","Warnings":["swap limit not supported"]}\n')
+
+            def do_DELETE(self):
+                self.record()
+                if 'gone' in self.path:
+                    return self.send(404, b'{"message":"No such container: gone"}')
+                self.send(204)
+
+            def do_GET(self):
+                self.record()
+                if 'gone' in self.path:
+                    return self.send(404, b'{"message":"No such container: gone"}')
+                self.send(200, b'{"Id":"c0ffee","State":{"Running":true},"Config":{"Env":["A=\\u003cb\\u003e"]}}\n')
+
+            def log_message(self, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        self.server = Server(path, Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class APITest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(dir=CACHE_DIR)
+        self.dockerd = FakeDockerd(os.path.join(self.tmp, 'docker.sock'))
+        patcher = mock.patch.dict(docker.DOCKER_API, {'enabled': True, 'socket': self.dockerd.path, 'timeout': 5})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.dockerd.stop()
+        shutil.rmtree(self.tmp)
+
+    def create(self, argv, gateway_disabled=False):
+        """
+        Run docker create through args_create() and the backend, as main() does.
+        Returns the result and the request body dockerd got.
+        """
+        with mock.patch.object(sys, 'argv', ['docker.py', 'create'] + argv), \
+             mock.patch.object(docker, 'get_host_identity', return_value=IDENTITY), \
+             mock.patch('os.path.isfile', return_value=gateway_disabled):
+            args = docker.args_create(argv)
+        result = docker.api_execute('create', args)
+        posts = [request for request in self.dockerd.requests if request[0] == 'POST']
+        return result, posts[-1] if posts else None
+
+    def test_create_vo_gateway(self):
+        result, (_, path, body, _) = self.create(['--name', 'job1', '--label=OWNER=lhcb001', '--memory=100m',
+                                                  '-e', 'X=1', 'busybox', '/bin/sh'])
+        self.assertEqual(result, (0, b'c0ffee\n', b'WARNING: swap limit not supported\n'))
+        self.assertEqual(path, '/containers/create?name=job1')
+        host = body['HostConfig']
+        self.assertEqual(host['Ulimits'], [{'Name': 'nofile', 'Soft': 1048575, 'Hard': 1048575}])
+        self.assertEqual(host['ExtraHosts'], [
+            'xrootd.echo.stfc.ac.uk ceph-gw10.gridpp.rl.ac.uk ceph-gw11.gridpp.rl.ac.uk ceph-svc06.gridpp.rl.ac.uk ceph-svc20.gridpp.rl.ac.uk:172.28.1.1',
+            'xrootd-gateway.echo.stfc.ac.uk:172.28.1.2',
+            'xrootd.echo.stfc.ac.uk ceph-gw10.gridpp.rl.ac.uk ceph-gw11.gridpp.rl.ac.uk ceph-svc06.gridpp.rl.ac.uk ceph-svc20.gridpp.rl.ac.uk:2001:db8:1:2:1000:2',
+            'xrootd-gateway.echo.stfc.ac.uk:2001:db8:1:2:1000:3',
+        ])
+        self.assertEqual(body['Labels'], {'xrootd-local-gateway': 'true', 'OWNER': 'lhcb001'})
+        self.assertEqual(body['Env'], [
+            'XrdSecGSISRVNAMES=lcg0001.gridpp.rl.ac.uk',
+            'APPTAINERENV_XrdSecGSISRVNAMES=lcg0001.gridpp.rl.ac.uk',
+            'SINGULARITYENV_XrdSecGSISRVNAMES=lcg0001.gridpp.rl.ac.uk',
+            'FRONTIER_LOG_FILE=frontier.log',
+            'XRD_STREAMTIMEOUT=300',
+            'APPTAINERENV_XRD_STREAMTIMEOUT=300',
+            'SINGULARITYENV_XRD_STREAMTIMEOUT=300',
+            'X=1',
+        ])
+        self.assertEqual(host['Memory'], 300 * 1024 ** 2)
+        self.assertEqual(host['MemorySwap'], 300 * 1024 ** 2)
+        self.assertEqual(host['MemoryReservation'], 100 * 1024 ** 2)
+        self.assertEqual(body['Image'], 'busybox')
+        self.assertEqual(body['Cmd'], ['nice', '-n 10', '/bin/sh'])
+
+    def test_create_other_vo(self):
+        _, (_, path, body, _) = self.create(['--label=OWNER=alice001', 'busybox', 'date'])
+        self.assertEqual(path, '/containers/create')
+        self.assertEqual(body['HostConfig']['Ulimits'], [{'Name': 'nofile', 'Soft': 2097152, 'Hard': 2097152}])
+        self.assertNotIn('ExtraHosts', body['HostConfig'])
+        self.assertEqual(body['Labels'], {'xrootd-local-gateway': 'false', 'OWNER': 'alice001'})
+        self.assertEqual(body['Cmd'], ['date'])
+
+    def test_create_gateway_disabled(self):
+        _, (_, _, body, _) = self.create(['--label=OWNER=atlas001', 'busybox', 'date'], gateway_disabled=True)
+        self.assertEqual(body['Labels']['xrootd-local-gateway'], 'false')
+        self.assertNotIn('Env', body)
+
+    def test_create_env_from_environment(self):
+        with mock.patch.dict(os.environ, {'SET_VAR': 'yes'}):
+            os.environ.pop('UNSET_VAR', None)
+            _, (_, _, body, _) = self.create(['-e', 'SET_VAR', '-e', 'UNSET_VAR', '--label=OWNER=alice001', 'busybox'])
+        self.assertEqual(body['Env'], ['SET_VAR=yes'])
+
+    def test_create_falls_back(self):
+        # options the backend doesn't know, and images that need pulling, are left to the CLI
+        result, body = self.create(['--privileged', 'busybox'])
+        self.assertIsNone(result)
+        self.assertIsNone(body)
+        result, body = self.create(['missing', 'date'])
+        self.assertIsNone(result)
+        self.assertEqual(body[2]['Image'], 'missing')
+
+    def test_create_error(self):
+        result, _ = self.create(['conflict'])
+        self.assertEqual(result, (1, b'', b'Error response from daemon: Conflict. The container name is already in use\n'))
+
+    def test_no_socket_falls_back(self):
+        with mock.patch.dict(docker.DOCKER_API, {'socket': os.path.join(self.tmp, 'nothing.sock')}):
+            self.assertIsNone(docker.api_execute('rm', ['job1']))
+
+    def test_disabled(self):
+        with mock.patch.dict(docker.DOCKER_API, {'enabled': False}):
+            self.assertIsNone(docker.api_execute('rm', ['job1']))
+        self.assertEqual(self.dockerd.requests, [])
+
+    def test_rm(self):
+        result = docker.api_execute('rm', ['-f', 'job1', 'gone', 'job2'])
+        self.assertEqual(result, (1, b'job1\njob2\n', b'Error response from daemon: No such container: gone\n'))
+        self.assertEqual([(method, path) for method, path, _, _ in self.dockerd.requests], [
+            ('DELETE', '/containers/job1?force=1'),
+            ('DELETE', '/containers/gone?force=1'),
+            ('DELETE', '/containers/job2?force=1'),
+        ])
+        # one connection for every request
+        self.assertEqual(len(set(connection for _, _, _, connection in self.dockerd.requests)), 1)
+        self.assertIsNone(docker.api_execute('rm', ['--link', 'job1']))
+
+    def test_inspect(self):
+        rc, output, err = docker.api_execute('inspect', ['job1'])
+        self.assertEqual((rc, err), (0, b''))
+        self.assertEqual(json.loads(output.decode()), [{'Id': 'c0ffee', 'State': {'Running': True}, 'Config': {'Env': ['A=<b>']}}])
+        # dockerd's escapes are kept, as the CLI keeps them
+        self.assertIn(b'"A=\\u003cb\\u003e"', output)
+        self.assertTrue(output.startswith(b'[\n    {\n        "Id": "c0ffee",'))
+
+    def test_inspect_falls_back(self):
+        self.assertIsNone(docker.api_execute('inspect', ['--format', '{{.State.Status}}', 'job1']))
+        self.assertIsNone(docker.api_execute('inspect', ['gone']))
+
+
+class CreateRequestTest(unittest.TestCase):
+    def test_options(self):
+        name, body = docker.api_create_request(['--rm', '-v', '/pool:/pool:rw', '-v', '/scratch', '--ulimit', 'core=0',
+                                                '--shm-size=1g', '-c', '512', '--entrypoint', '/bin/bash', 'centos:7', '-c', 'true'])
+        self.assertIsNone(name)
+        host = body['HostConfig']
+        self.assertTrue(host['AutoRemove'])
+        self.assertEqual(host['Binds'], ['/pool:/pool:rw'])
+        self.assertEqual(body['Volumes'], {'/scratch': {}})
+        self.assertEqual(host['Ulimits'], [{'Name': 'core', 'Soft': 0, 'Hard': 0}])
+        self.assertEqual(host['ShmSize'], 1024 ** 3)
+        self.assertEqual(host['CpuShares'], 512)
+        self.assertEqual(body['Entrypoint'], ['/bin/bash'])
+        self.assertEqual(body['Cmd'], ['-c', 'true'])
+
+    def test_unhandled(self):
+        self.assertIsNone(docker.api_create_request(['--memory', 'lots', 'busybox']))
+        self.assertIsNone(docker.api_create_request(['--name']))
+        self.assertIsNone(docker.api_create_request(['--rm']))
+
+
+class PolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(dir=CACHE_DIR)
+        patcher = mock.patch.dict(docker.POLICY, {'filename': os.path.join(self.tmp, 'docker_policy.json'),
+                                                  'compiled': os.path.join(self.tmp, 'policy.json')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_default_policy_change(self):
+        self.assertEqual(docker.load_policy()['memory_multiplier'], 3)
+        self.assertTrue(os.path.exists(docker.POLICY['compiled']))
+        with mock.patch.dict(docker.DEFAULT_POLICY, {'memory': {'multiplier': 5, 'swap_multiplier': 5}}):
+            self.assertEqual(docker.load_policy()['memory_multiplier'], 5)
+
+    def test_policy_file(self):
+        policy = json.loads(json.dumps(docker.DEFAULT_POLICY))
+        policy['nice'] = 5
+        with open(docker.POLICY['filename'], 'w') as f:
+            json.dump(policy, f)
+        self.assertEqual(docker.load_policy()['nice'], ['nice', '-n 5'])
+        policy['nice'] = 15
+        with open(docker.POLICY['filename'], 'w') as f:
+            json.dump(policy, f)
+        os.utime(docker.POLICY['filename'], (0, 0))
+        self.assertEqual(docker.load_policy()['nice'], ['nice', '-n 15'])
+
+
+class CacheFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(dir=CACHE_DIR)
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_round_trip(self):
+        filename = os.path.join(self.tmp, 'commands', 'data.json')
+        docker.write_cache_file(filename, {'a': [1, 2]})
+        self.assertEqual(docker.read_cache_file(filename), {'a': [1, 2]})
+        self.assertEqual(os.stat(os.path.dirname(filename)).st_mode & 0o777, 0o700)
+
+    def test_directory_others_can_write(self):
+        os.chmod(self.tmp, 0o1777)
+        filename = os.path.join(self.tmp, 'data.json')
+        docker.write_cache_file(filename, {'a': 1})
+        self.assertFalse(os.path.exists(filename))
+        with open(filename, 'w') as f:
+            json.dump({'a': 1}, f)
+        self.assertIsNone(docker.read_cache_file(filename))
+
+    @unittest.skipUnless(os.getuid() == 0, 'needs root to give the directory away')
+    def test_directory_owned_by_someone_else(self):
+        os.chown(self.tmp, 65534, -1)
+        filename = os.path.join(self.tmp, 'data.json')
+        with open(filename, 'w') as f:
+            json.dump({'a': 1}, f)
+        self.assertIsNone(docker.read_cache_file(filename))
+
+    def test_symlinked_directory(self):
+        os.mkdir(os.path.join(self.tmp, 'real'), 0o700)
+        os.symlink(os.path.join(self.tmp, 'real'), os.path.join(self.tmp, 'link'))
+        with open(os.path.join(self.tmp, 'real', 'data.json'), 'w') as f:
+            json.dump({'a': 1}, f)
+        self.assertIsNone(docker.read_cache_file(os.path.join(self.tmp, 'link', 'data.json')))
+
+    def test_symlinked_file(self):
+        with open(os.path.join(self.tmp, 'elsewhere.json'), 'w') as f:
+            json.dump({'a': 1}, f)
+        os.symlink(os.path.join(self.tmp, 'elsewhere.json'), os.path.join(self.tmp, 'data.json'))
+        self.assertIsNone(docker.read_cache_file(os.path.join(self.tmp, 'data.json')))
+
+    def test_outside_cache_dir(self):
+        self.assertIsNone(docker.read_cache_file('/etc/hostname'))
+
+    def test_compiled_policy_is_json(self):
+        with mock.patch.dict(docker.POLICY, {'filename': os.path.join(self.tmp, 'none.json'),
+                                             'compiled': os.path.join(self.tmp, 'policy.json')}):
+            table = docker.load_policy()
+            with open(docker.POLICY['compiled']) as f:
+                self.assertEqual(json.load(f)['table'], table)
+            self.assertEqual(docker.args_create(['--memory=100m'])[-3:],
+                             ['--memory=300m', '--memory-swap=300m', '--memory-reservation=100m'])
+
+
+class MainTest(unittest.TestCase):
+    """
+    Which commands the wrapper replaces itself with, and which it waits for
+    """
+    def run_main(self, argv):
+        calls = []
+        with mock.patch.object(sys, 'argv', ['docker.py'] + argv), \
+                mock.patch.object(docker, 'api_execute', return_value=None), \
+                mock.patch.object(docker, 'invalidate_cache', side_effect=lambda: calls.append('invalidate')), \
+                mock.patch.object(docker, 'execute', side_effect=lambda args: calls.append('execute') or sys.exit(0)), \
+                mock.patch.object(docker, 'wait_execute', side_effect=lambda args: calls.append('wait') or 0):
+            with self.assertRaises(SystemExit):
+                docker.main()
+        return calls
+
+    def test_start_is_execed(self):
+        self.assertEqual(self.run_main(['start', '-a', 'abc']), ['invalidate', 'execute'])
+
+    def test_stop_is_waited_for(self):
+        self.assertEqual(self.run_main(['stop', 'abc']), ['invalidate', 'wait', 'invalidate'])
+
+    def test_other_command_is_execed(self):
+        self.assertEqual(self.run_main(['logs', 'abc']), ['execute'])
+
+
+def tearDownModule():
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,266 @@
+"""
+Tests for the drain planning in efficientdefrag.py, on startd, slot and job ads given as dicts
+the way --replay does. efficientdefrag.py is Python 2, so run with python2 -m unittest discover tests
+"""
+
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest('efficientdefrag.py is Python 2')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import efficientdefrag
+import fake_htcondor
+
+logging.getLogger('condor_efficient_defrag').addHandler(logging.NullHandler())
+
+
+class Pool(object):
+    """
+    Builds the inputs to plan_cycle()
+    """
+    def __init__(self):
+        self.startds = []
+        self.running_jobs = {}
+        self.schedd_jobs = {'schedd1': []}
+        self.next_id = 1
+
+    def job_id(self):
+        self.next_id += 1
+        return 'schedd1#%i.0#1' % self.next_id
+
+    def idle(self, request_cpus, count=1):
+        for _ in range(count):
+            self.schedd_jobs['schedd1'].append({'JobStatus': 1, 'RequestCpus': request_cpus, 'GlobalJobId': self.job_id()})
+
+    def machine(self, name, total_cpus, free, preemptable, busy, draining=False, drain_slot_size=None):
+        """
+        A machine with free CPUs, single core preemptable jobs and single core jobs that can't be preempted
+        """
+        startd = {'Name': 'slot1@' + name, 'Machine': name, 'PartitionableSlot': True, 'PREEMPTABLE_ONLY': draining,
+                  'NODE_IS_HEALTHY': True, 'StartJobs': True, 'TotalCpus': total_cpus, 'Cpus': free}
+        if drain_slot_size is not None:
+            startd['DRAIN_SLOT_SIZE'] = drain_slot_size
+        self.startds.append(startd)
+        jobs = self.running_jobs.setdefault(name, [])
+        for i in range(preemptable + busy):
+            global_id = self.job_id()
+            jobs.append({'JobId': global_id.split('#')[1], 'GlobalJobId': global_id, 'EnteredCurrentActivity': 1000 + i, 'Machine': name})
+            if i < preemptable:
+                self.schedd_jobs['schedd1'].append({'JobStatus': 2, 'RequestCpus': 1, 'GlobalJobId': global_id,
+                                                    'isPreemptable': True, 'JobCurrentStartDate': 1000 + i})
+
+    def plan(self):
+        reachable = dict((startd['Machine'], True) for startd in self.startds)
+        return efficientdefrag.plan_cycle(self.startds, self.running_jobs, self.schedd_jobs, reachable)
+
+
+def names(machines):
+    return sorted(machine.name for machine in machines)
+
+
+class PlanCycleTest(unittest.TestCase):
+
+    def mixed_demand(self):
+        pool = Pool()
+        pool.idle(8)
+        pool.idle(16, 3)
+        return pool
+
+    def test_draining_for_bigger_slot_continues(self):
+        pool = self.mixed_demand()
+        pool.machine('a', 32, 4, 5, 23, draining=True, drain_slot_size=16)
+        plan = pool.plan()
+        self.assertEqual(plan.drain_finished, [])
+        self.assertEqual(plan.kills, [])
+        self.assertEqual(plan.machines_draining, 1)
+
+    def test_draining_for_bigger_slot_finishes(self):
+        pool = self.mixed_demand()
+        pool.machine('a', 32, 12, 5, 15, draining=True, drain_slot_size=16)
+        plan = pool.plan()
+        self.assertEqual(names(plan.drain_finished), ['a'])
+        self.assertEqual(names(plan.kills), ['a'])
+        self.assertEqual(plan.kills[0].kill_this_many, 4)
+
+    def test_drain_slot_size_not_recorded(self):
+        pool = self.mixed_demand()
+        pool.machine('a', 32, 4, 5, 23, draining=True)
+        plan = pool.plan()
+        self.assertEqual(names(plan.drain_finished), ['a'])
+        self.assertEqual(plan.kills[0].kill_this_many, 4)
+
+    def test_drain_slot_size_no_longer_wanted(self):
+        pool = Pool()
+        pool.idle(8)
+        pool.machine('a', 32, 4, 5, 23, draining=True, drain_slot_size=16)
+        plan = pool.plan()
+        self.assertEqual(names(plan.drain_finished), ['a'])
+
+    def test_drains_are_shared_by_size(self):
+        pool = Pool()
+        pool.idle(8, 2)
+        pool.idle(16, 2)
+        pool.idle(64)
+        # one machine to drain for each size
+        pool.machine('sixteen', 32, 7, 0, 25)
+        pool.machine('eight', 32, 6, 0, 26)
+        pool.machine('whole', 32, 5, 0, 27)
+        efficientdefrag.CONCURRECY['default'], default = 3, efficientdefrag.CONCURRECY['default']
+        try:
+            plan = pool.plan()
+        finally:
+            efficientdefrag.CONCURRECY['default'] = default
+        self.assertEqual(dict((machine.name, machine.free_up_n_cpus) for machine in plan.drains),
+                         {'sixteen': 16, 'eight': 8, 'whole': 32})
+
+    def test_start_draining_records_size(self):
+        pool = Pool()
+        pool.idle(16)
+        pool.machine('a', 32, 12, 0, 20)
+        plan = pool.plan()
+        self.assertEqual(names(plan.drains), ['a'])
+
+        changes = {}
+        def reconfigure_machines(machines):
+            changes.update(machines)
+            return dict((name, True) for name in machines)
+        real, efficientdefrag.reconfigure_machines = efficientdefrag.reconfigure_machines, reconfigure_machines
+        try:
+            efficientdefrag.execute_plan(plan, None, None)
+        finally:
+            efficientdefrag.reconfigure_machines = real
+        self.assertEqual(changes, {'a': [('PREEMPTABLE_ONLY', 'True'), ('DRAIN_SLOT_SIZE', '16')]})
+
+
+class ScheddLatencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='efficientdefrag-test-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.timeout = efficientdefrag.SCHEDD_QUERY['timeout']
+        efficientdefrag.SCHEDD_QUERY['timeout'] = 0.5
+        efficientdefrag.STATS.reset()
+        self.hang = threading.Event()
+        self.addCleanup(self.hang.set)
+
+    def tearDown(self):
+        efficientdefrag.SCHEDD_QUERY['timeout'] = self.timeout
+
+    def test_failed_and_timed_out_queries(self):
+        hang = self.hang
+        def get_schedd_jobs(schedds, hostname):
+            if hostname == 'broken':
+                raise IOError('no schedd')
+            if hostname == 'hung':
+                hang.wait()
+            return [{'JobStatus': 1, 'RequestCpus': 8, 'GlobalJobId': '%s#1.0#1' % hostname}]
+        real, efficientdefrag.get_schedd_jobs = efficientdefrag.get_schedd_jobs, get_schedd_jobs
+        try:
+            results = efficientdefrag.get_all_schedd_jobs(None, ['ok', 'broken', 'hung'])
+        finally:
+            efficientdefrag.get_schedd_jobs = real
+        self.assertEqual(list(results), ['ok'])
+
+        latencies = efficientdefrag.STATS.summary()['schedd_latencies']
+        self.assertEqual(latencies['broken'], 0.5)
+        self.assertEqual(latencies['hung'], 0.5)
+        self.assertTrue(latencies['ok'] < 0.5)
+
+        filename = os.path.join(self.directory, 'efficientdefrag.prom')
+        efficientdefrag.STATS.write_prometheus(filename)
+        with open(filename) as prometheus_file:
+            lines = prometheus_file.read().splitlines()
+        self.assertTrue('# TYPE efficientdefrag_last_cycle_schedd_query_seconds gauge' in lines)
+        self.assertTrue('efficientdefrag_last_cycle_schedd_query_seconds{schedd="hung"} 0.500000' in lines)
+        self.assertTrue('efficientdefrag_last_cycle_schedd_query_seconds{schedd="broken"} 0.500000' in lines)
+        self.assertFalse([line for line in lines if 'histogram' in line or '_bucket' in line])
+
+
+class ReachabilityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.addCleanup(self.listener.close)
+        self.settings = dict(efficientdefrag.REACHABILITY)
+        efficientdefrag.REACHABILITY['port'] = self.listener.getsockname()[1]
+
+    def tearDown(self):
+        efficientdefrag.REACHABILITY.update(self.settings)
+
+    def test_probe(self):
+        reachable = efficientdefrag.probe_reachability(['127.0.0.1', '127.0.0.2', 'nonexistent.invalid', '127.0.0.1'])
+        self.assertEqual(reachable, {'127.0.0.1': True, '127.0.0.2': False, 'nonexistent.invalid': False})
+
+    def test_one_connection_at_a_time(self):
+        efficientdefrag.REACHABILITY['max_open'] = 1
+        reachable = efficientdefrag.probe_reachability(['127.0.0.1', '127.0.0.2', '127.0.0.3'])
+        self.assertEqual(reachable, {'127.0.0.1': True, '127.0.0.2': False, '127.0.0.3': False})
+
+    def test_deadline(self):
+        efficientdefrag.REACHABILITY['deadline'] = 0
+        self.assertEqual(efficientdefrag.probe_reachability(['127.0.0.1', '127.0.0.2']), {'127.0.0.1': None, '127.0.0.2': None})
+
+
+class RunningJobsTest(unittest.TestCase):
+
+    def setUp(self):
+        real, efficientdefrag.htcondor = efficientdefrag.htcondor, fake_htcondor
+        self.addCleanup(setattr, efficientdefrag, 'htcondor', real)
+        self.constraints = []
+
+    def query(self, ad_type, constraint="", projection=None):
+        self.constraints.append(constraint)
+        return []
+
+    def test_excluded_clusters(self):
+        efficientdefrag.get_running_jobs(self)
+        efficientdefrag.get_running_jobs(self, ['wn1', 'wn2'])
+        self.assertEqual(len(self.constraints), 2)
+        for constraint in self.constraints:
+            self.assertTrue(efficientdefrag.CLUSTER_CONSTRAINT in constraint)
+        self.assertTrue(efficientdefrag.CLUSTER_CONSTRAINT in efficientdefrag.STARTD_CONSTRAINT)
+
+
+class PoolModelTest(unittest.TestCase):
+
+    def setUp(self):
+        real, efficientdefrag.htcondor = efficientdefrag.htcondor, fake_htcondor
+        self.addCleanup(setattr, efficientdefrag, 'htcondor', real)
+        self.pool = fake_htcondor.SyntheticPool(20, draining_fraction=0, schedds=3, idle_multicore=10)
+        fake_htcondor.use_pool(self.pool)
+        self.model = efficientdefrag.PoolModel(fake_htcondor.Collector('localhost'), full_refresh_cycles=12)
+        self.model.refresh()
+
+    def test_vanished_startd_dropped(self):
+        gone = self.pool.startds.pop(3)
+        machine = gone['Machine']
+        del self.pool.slots[machine]
+        self.assertTrue(gone['Name'] in self.model.startds)
+        self.assertTrue(machine in self.model.running_jobs)
+
+        self.model.refresh()
+        self.assertEqual(self.model.cycle, 2)
+        self.assertFalse(gone['Name'] in self.model.startds)
+        self.assertFalse(machine in self.model.running_jobs)
+        self.assertEqual(len(self.model.startds), 19)
+
+    def test_schedds_refreshed(self):
+        self.assertEqual(len(self.model.schedd_hosts), 3)
+        self.pool.schedd_names.append('arc-ce99.gridpp.rl.ac.uk')
+        self.model.refresh()
+        self.assertEqual(self.model.cycle, 2)
+        self.assertTrue('arc-ce99.gridpp.rl.ac.uk' in self.model.schedd_hosts)
+
+
+if __name__ == '__main__':
+    unittest.main()
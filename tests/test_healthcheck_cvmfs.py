@@ -0,0 +1,191 @@
+"""
+Tests for the CernVM-FS repository probes in healthcheck_cvmfs.py, with the extended
+attributes cvmfs2 serves and the cache partition's statvfs mocked.
+Run with python3 -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import healthcheck_cvmfs
+
+
+class ConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='healthcheck-cvmfs-test-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        config_dir = healthcheck_cvmfs.CONFIG_DIR
+        healthcheck_cvmfs.CONFIG_DIR = self.directory
+        self.addCleanup(setattr, healthcheck_cvmfs, 'CONFIG_DIR', config_dir)
+        for subdirectory in ('default.d', 'domain.d', 'config.d'):
+            os.mkdir(os.path.join(self.directory, subdirectory))
+
+    def write(self, filename, text):
+        with open(os.path.join(self.directory, filename), 'w') as f:
+            f.write(text)
+
+    def test_no_default_config(self):
+        with self.assertRaises(healthcheck_cvmfs.ProbeError) as raised:
+            healthcheck_cvmfs.read_config('cms.cern.ch')
+        self.assertEqual(raised.exception.status, healthcheck_cvmfs.STATUS_UNKNOWN)
+
+    def test_defaults(self):
+        self.write('default.conf', '')
+        fqrn, config = healthcheck_cvmfs.read_config('cms')
+        self.assertEqual(fqrn, 'cms.cern.ch')
+        self.assertEqual(config['CVMFS_MOUNT_DIR'], '/cvmfs')
+        self.assertEqual(config['CVMFS_CACHE_BASE'], '/var/lib/cvmfs')
+
+    def test_order(self):
+        self.write('default.conf', 'CVMFS_CACHE_BASE=/default\nCVMFS_QUOTA_LIMIT=4000\n')
+        self.write('default.d/50-site.conf', '# the site\nexport CVMFS_CACHE_BASE="/site" # comment\n')
+        self.write('default.local', "CVMFS_DEFAULT_DOMAIN='gridpp.ac.uk'\nnot a setting\n")
+        self.write('domain.d/gridpp.ac.uk.conf', 'CVMFS_SERVER_URL=http://domain\n')
+        self.write('config.d/lhcb.gridpp.ac.uk.local', 'CVMFS_CACHE_BASE=/repository\n')
+        fqrn, config = healthcheck_cvmfs.read_config('lhcb')
+        self.assertEqual(fqrn, 'lhcb.gridpp.ac.uk')
+        self.assertEqual(config['CVMFS_CACHE_BASE'], '/repository')
+        self.assertEqual(config['CVMFS_QUOTA_LIMIT'], '4000')
+        self.assertEqual(config['CVMFS_SERVER_URL'], 'http://domain')
+        self.assertFalse('not a setting' in config)
+
+    def test_other_repository_config(self):
+        self.write('default.conf', 'CVMFS_CACHE_BASE=/default\n')
+        self.write('config.d/atlas.cern.ch.local', 'CVMFS_CACHE_BASE=/atlas\n')
+        self.assertEqual(healthcheck_cvmfs.read_config('cms.cern.ch')[1]['CVMFS_CACHE_BASE'], '/default')
+
+
+class CheckRepositoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='healthcheck-cvmfs-test-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.mount_dir = os.path.join(self.directory, 'cvmfs')
+        self.repository = os.path.join(self.mount_dir, 'cms.cern.ch')
+        os.makedirs(self.repository)
+        config = {'CVMFS_MOUNT_DIR': self.mount_dir, 'CVMFS_CACHE_BASE': '/var/lib/cvmfs'}
+        self.xattrs = {'version': '2.11.2', 'nioerr': '0', 'usedfd': '20', 'maxfd': '1000', 'nclg': '10',
+                       'revision': '1234', 'ncleanup24': '0', 'timestamp_last_ioerr': '0'}
+        # 1000 blocks, 900 used
+        self.cache = mock.Mock(f_blocks=1000, f_bfree=100, f_bavail=100)
+        for patch in [mock.patch.object(healthcheck_cvmfs, 'read_config', return_value=('cms.cern.ch', config)),
+                      mock.patch.object(healthcheck_cvmfs, 'get_installed_version', return_value='2.11.2.0'),
+                      mock.patch.object(healthcheck_cvmfs.os, 'getxattr', side_effect=self.getxattr),
+                      mock.patch.object(healthcheck_cvmfs.os, 'statvfs', side_effect=self.statvfs)]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def getxattr(self, path, name):
+        self.assertEqual(path, self.repository)
+        value = self.xattrs.get(name[len('user.'):])
+        if value is None:
+            raise OSError(61, 'No data available')
+        return value.encode()
+
+    def statvfs(self, path):
+        self.assertEqual(path, '/var/lib/cvmfs')
+        if self.cache is None:
+            raise OSError(2, 'No such file or directory')
+        return self.cache
+
+    def test_ok(self):
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch'), (healthcheck_cvmfs.STATUS_OK, 'OK; repository revision 1234'))
+
+    def test_inaccessible(self):
+        os.rmdir(self.repository)
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch'),
+                         (healthcheck_cvmfs.STATUS_CRITICAL, 'failed to access cms.cern.ch'))
+
+    def test_missing_attribute(self):
+        del self.xattrs['nclg']
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch'),
+                         (healthcheck_cvmfs.STATUS_UNKNOWN, 'failed to read nclg attribute'))
+
+    def test_bad_attribute(self):
+        self.xattrs['usedfd'] = 'lots'
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch')[0], healthcheck_cvmfs.STATUS_UNKNOWN)
+
+    def test_optional_attributes(self):
+        # cvmfs before 2.4 serves neither
+        del self.xattrs['ncleanup24']
+        del self.xattrs['timestamp_last_ioerr']
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch')[0], healthcheck_cvmfs.STATUS_OK)
+
+    def test_version_mismatch(self):
+        self.xattrs['version'] = '2.10'
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch'),
+                         (healthcheck_cvmfs.STATUS_WARNING,
+                          'version mismatch (loaded 2.10.0.0, installed 2.11.2.0); repository revision 1234'))
+
+    def test_io_errors(self):
+        self.xattrs['nioerr'] = '3'
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch'),
+                         (healthcheck_cvmfs.STATUS_WARNING, '3 I/O errors detected; repository revision 1234'))
+        self.xattrs['timestamp_last_ioerr'] = str(int(time.time()) - 60 * 60)
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch')[0], healthcheck_cvmfs.STATUS_WARNING)
+
+    def test_old_io_errors(self):
+        self.xattrs['nioerr'] = '3'
+        self.xattrs['timestamp_last_ioerr'] = str(int(time.time()) - 4 * 60 * 60)
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch')[0], healthcheck_cvmfs.STATUS_OK)
+
+    def test_file_descriptors(self):
+        self.xattrs['usedfd'] = '800'
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch')[0], healthcheck_cvmfs.STATUS_OK)
+        self.xattrs['usedfd'] = '810'
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch'),
+                         (healthcheck_cvmfs.STATUS_WARNING, 'low on open file descriptors (81%); repository revision 1234'))
+
+    def test_catalogs(self):
+        self.xattrs['nclg'] = '101'
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch'),
+                         (healthcheck_cvmfs.STATUS_WARNING, 'high no. loaded catalogs (101); repository revision 1234'))
+
+    def test_cache_fill(self):
+        # 950 of 1000 is 95%, 951 rounds up to 96%
+        self.cache = mock.Mock(f_blocks=1000, f_bfree=50, f_bavail=50)
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch')[0], healthcheck_cvmfs.STATUS_OK)
+        self.cache = mock.Mock(f_blocks=1000, f_bfree=49, f_bavail=49)
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch'),
+                         (healthcheck_cvmfs.STATUS_WARNING, 'space on cache partition low; repository revision 1234'))
+
+    def test_cache_missing(self):
+        self.cache = None
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch'),
+                         (healthcheck_cvmfs.STATUS_CRITICAL, 'failed to stat /var/lib/cvmfs; repository revision 1234'))
+
+    def test_cleanups(self):
+        self.xattrs['ncleanup24'] = '25'
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch'),
+                         (healthcheck_cvmfs.STATUS_WARNING,
+                          'frequent cache cleanups, cache might be undersized; repository revision 1234'))
+
+    def test_several_problems(self):
+        self.xattrs['version'] = '2.10.1'
+        self.xattrs['nclg'] = '200'
+        self.cache = None
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch'),
+                         (healthcheck_cvmfs.STATUS_CRITICAL,
+                          'version mismatch (loaded 2.10.1.0, installed 2.11.2.0); high no. loaded catalogs (200); '
+                          'failed to stat /var/lib/cvmfs; repository revision 1234'))
+
+    def test_dirtab_unreadable(self):
+        dirtab = os.path.join(self.repository, '.cvmfsdirtab')
+        with open(dirtab, 'w') as f:
+            f.write('/*\n')
+        self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch')[0], healthcheck_cvmfs.STATUS_OK)
+        with mock.patch('builtins.open', side_effect=OSError(5, 'Input/output error')):
+            self.assertEqual(healthcheck_cvmfs.probe('cms.cern.ch'),
+                             (healthcheck_cvmfs.STATUS_CRITICAL,
+                              'failed to read .cvmfsdirtab from repository; repository revision 1234'))
+
+
+if __name__ == '__main__':
+    unittest.main()
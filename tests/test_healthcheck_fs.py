@@ -0,0 +1,135 @@
+"""
+Tests for the mount table and free space probes in healthcheck_fs.py.
+Run with python3 -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import healthcheck_fs
+
+MOUNTINFO = """\
+22 1 253:0 / / rw,relatime shared:1 - xfs /dev/mapper/root rw,attr2,inode64
+23 22 0:21 / /proc rw,nosuid,nodev,noexec,relatime shared:5 - proc proc rw
+40 22 8:1 / /boot rw,relatime shared:26 - ext4 /dev/sda1 rw
+41 22 8:16 / /pool rw,relatime shared:27 - xfs /dev/sdb rw,attr2,inode64
+42 41 8:16 /condor/execute /var/lib/condor/execute rw,relatime shared:27 - xfs /dev/sdb rw,attr2,inode64
+43 22 0:45 / /cvmfs/cms.cern.ch ro,nosuid,nodev,relatime shared:30 - fuse cvmfs2 ro,user_id=0
+44 22 0:46 / /tmp/fuse rw,relatime shared:31 - fuse /dev/fuse rw
+45 22 0:47 / /dev/shm rw,nosuid,nodev shared:32 - tmpfs tmpfs rw
+46 22 252:16 / /mnt/context ro,relatime shared:33 - iso9660 /dev/vdb ro
+47 22 8:32 / /mnt/scratch\\040disk rw,relatime shared:34 - ext4 /dev/sdc rw
+not a mountinfo line
+"""
+
+
+def mount(device, mount_point, fstype='ext4', source='/dev/sda1'):
+    return healthcheck_fs.Mount(device, mount_point, fstype, source)
+
+def statvfs(blocks, bfree, bavail, frsize=4096):
+    return mock.Mock(f_blocks=blocks, f_bfree=bfree, f_bavail=bavail, f_frsize=frsize)
+
+
+class MountTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='healthcheck-fs-test-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.mountinfo = os.path.join(self.directory, 'mountinfo')
+        with open(self.mountinfo, 'w') as f:
+            f.write(MOUNTINFO)
+
+    def test_unescape(self):
+        self.assertEqual(healthcheck_fs.unescape(r'/mnt/a\040b'), '/mnt/a b')
+        self.assertEqual(healthcheck_fs.unescape(r'/mnt/a\011b\012c\134d'), '/mnt/a\tb\nc\\d')
+        self.assertEqual(healthcheck_fs.unescape('/mnt/plain'), '/mnt/plain')
+
+    def test_read_mounts(self):
+        mounts = healthcheck_fs.read_mounts(self.mountinfo)
+        self.assertEqual(len(mounts), 10)
+        root = mounts[0]
+        self.assertEqual((root.device, root.mount_point, root.fstype, root.source), ('253:0', '/', 'xfs', '/dev/mapper/root'))
+        self.assertEqual(mounts[4].mount_point, '/var/lib/condor/execute')
+        self.assertEqual(mounts[4].device, '8:16')
+        self.assertEqual((mounts[5].fstype, mounts[5].source), ('fuse', 'cvmfs2'))
+        self.assertEqual(mounts[-1].mount_point, '/mnt/scratch disk')
+
+    def test_read_mounts_missing(self):
+        self.assertEqual(healthcheck_fs.read_mounts(os.path.join(self.directory, 'missing')), [])
+
+    def test_is_mountpoint(self):
+        mounts = healthcheck_fs.read_mounts(self.mountinfo)
+        self.assertTrue(healthcheck_fs.is_mountpoint('/pool', mounts))
+        self.assertTrue(healthcheck_fs.is_mountpoint('/pool/', mounts))
+        self.assertFalse(healthcheck_fs.is_mountpoint('/pool/condor', mounts))
+
+    def test_find_mount(self):
+        mounts = healthcheck_fs.read_mounts(self.mountinfo)
+        self.assertEqual(healthcheck_fs.find_mount('/pool', mounts).mount_point, '/pool')
+        self.assertEqual(healthcheck_fs.find_mount('/pool/condor/x', mounts).mount_point, '/pool')
+        self.assertEqual(healthcheck_fs.find_mount('/var/lib/condor/execute/dir_1', mounts).mount_point, '/var/lib/condor/execute')
+        self.assertEqual(healthcheck_fs.find_mount('/var/lib/condor', mounts).mount_point, '/')
+        self.assertEqual(healthcheck_fs.find_mount('/mnt/scratch disk/a', mounts).device, '8:32')
+        self.assertIsNone(healthcheck_fs.find_mount('/pool', []))
+
+    def test_find_mount_prefix(self):
+        mounts = [mount('8:1', '/'), mount('8:2', '/pool')]
+        self.assertEqual(healthcheck_fs.find_mount('/poolside', mounts).mount_point, '/')
+
+    def test_find_mount_hidden(self):
+        # the later mount on /pool hides the earlier one
+        mounts = [mount('8:1', '/'), mount('8:2', '/pool'), mount('8:3', '/pool')]
+        self.assertEqual(healthcheck_fs.find_mount('/pool/condor', mounts).device, '8:3')
+
+    def test_local_filesystems(self):
+        mounts = healthcheck_fs.read_mounts(self.mountinfo)
+        # not proc, tmpfs or fuse, and /pool only once; /mnt/context is left to the caller
+        self.assertEqual([m.mount_point for m in healthcheck_fs.local_filesystems(mounts)],
+                         ['/', '/boot', '/pool', '/mnt/context', '/mnt/scratch disk'])
+
+    def test_local_filesystems_bind_mount(self):
+        # a device bind mounted somewhere shorter is listed there, in the order of that mount
+        mounts = [mount('8:1', '/'), mount('8:3', '/var/lib/docker'), mount('8:2', '/boot'), mount('8:3', '/srv')]
+        self.assertEqual([m.mount_point for m in healthcheck_fs.local_filesystems(mounts)], ['/', '/boot', '/srv'])
+
+
+class SpaceTest(unittest.TestCase):
+
+    def space(self, *args, **kwargs):
+        with mock.patch.object(healthcheck_fs.os, 'statvfs', return_value=statvfs(*args, **kwargs)) as statvfs_mock:
+            space = healthcheck_fs.Space('/pool')
+        statvfs_mock.assert_called_once_with('/pool')
+        return space
+
+    def test_free_mb(self):
+        # only what is available to users, not the reserved blocks
+        self.assertEqual(self.space(1000000, 400000, 256000).free_mb, 1000)
+        self.assertEqual(self.space(1000000, 400000, 256000, frsize=1024).free_mb, 250)
+
+    def test_percent_rounded_up(self):
+        # 95% used exactly, the 5% check_disk needs
+        self.assertEqual(self.space(1000, 50, 50).free_percent, 5)
+        # 95.1% used is 96% to df
+        self.assertEqual(self.space(1000, 49, 49).free_percent, 4)
+
+    def test_percent_reserved_blocks(self):
+        # df leaves the reserved blocks out of the size: 900 of 950 is 94.7%, so 95% used
+        self.assertEqual(self.space(1000, 100, 50).free_percent, 5)
+        self.assertEqual(self.space(1000, 100, 45).free_percent, 4)
+
+    def test_empty_filesystem(self):
+        self.assertEqual(self.space(0, 0, 0).free_percent, 100)
+
+    def test_full_filesystem(self):
+        space = self.space(1000, 20, 0)
+        self.assertEqual(space.free_percent, 0)
+        self.assertEqual(space.free_mb, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+"""
+Tests for the cache of passing checks and the disk checks in healthcheck_wn_condor.
+Run with python3 -m unittest discover tests
+"""
+
+import importlib.machinery
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+# healthcheck_wn_condor is a script without a .py extension
+loader = importlib.machinery.SourceFileLoader('healthcheck_wn_condor', os.path.join(ROOT, 'healthcheck_wn_condor'))
+spec = importlib.util.spec_from_loader(loader.name, loader)
+healthcheck = importlib.util.module_from_spec(spec)
+loader.exec_module(healthcheck)
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='healthcheck-test-')
+        self.cache_file = healthcheck.CACHE_FILE
+        healthcheck.CACHE_FILE = os.path.join(self.directory, 'healthcheck_wn_condor.json')
+        self.ran = []
+
+    def tearDown(self):
+        healthcheck.CACHE_FILE = self.cache_file
+        shutil.rmtree(self.directory)
+
+    def check(self, name, result, ttl=300, fatal=True):
+        def test(probe):
+            self.ran.append(name)
+            return result
+        return healthcheck.Check(name, test, 10, fatal=fatal, ttl=ttl)
+
+    def run_checks(self, checks, cache=None):
+        """
+        One run of checks, starting with cache, returning the cache it saved
+        """
+        if cache is not None:
+            with open(healthcheck.CACHE_FILE, 'w') as f:
+                json.dump(cache, f)
+        self.ran = []
+        node = healthcheck.Node(False)
+        node.run(checks)
+        for check in checks:
+            node.result(check)
+        node.save_cache()
+        with open(healthcheck.CACHE_FILE) as f:
+            return node.start, json.load(f)
+
+    def test_passes_cached_for_ttl(self):
+        checks = [self.check('ntp', None), self.check('docker_run', None, ttl=900), self.check('uptime', None, ttl=0)]
+        start, cache = self.run_checks(checks, {})
+        self.assertEqual(sorted(self.ran), ['docker_run', 'ntp', 'uptime'])
+        self.assertEqual(cache, {'ntp': start, 'docker_run': start})
+
+        # run again inside the ttl, only the check without one runs
+        _, cache = self.run_checks(checks)
+        self.assertEqual(self.ran, ['uptime'])
+        self.assertEqual(cache, {'ntp': start, 'docker_run': start})
+
+        # ntp's ttl is up
+        _, cache = self.run_checks(checks, {'ntp': start - 400, 'docker_run': start - 400})
+        self.assertEqual(sorted(self.ran), ['ntp', 'uptime'])
+
+    def test_failure_only_drops_what_failed(self):
+        checks = [self.check('ntp', None), self.check('docker_run', None, ttl=900),
+                  self.check('cvmfs_cms.cern.ch', 'Problem: CVMFS for cms.cern.ch', fatal=False),
+                  self.check('xrootd_gateway', 'unhealthy', ttl=0, fatal=False)]
+        earlier = healthcheck.time.time() - 100
+        start, cache = self.run_checks(checks, {'ntp': earlier, 'cvmfs_cms.cern.ch': earlier - 300})
+        self.assertEqual(sorted(self.ran), ['cvmfs_cms.cern.ch', 'docker_run', 'xrootd_gateway'])
+        self.assertEqual(cache, {'ntp': earlier, 'docker_run': start})
+
+        # a node that stays like this still only runs the cached checks once per ttl
+        _, cache = self.run_checks(checks)
+        self.assertEqual(sorted(self.ran), ['cvmfs_cms.cern.ch', 'xrootd_gateway'])
+        self.assertEqual(cache, {'ntp': earlier, 'docker_run': start})
+
+    def test_checks_not_finished_are_dropped(self):
+        checks = [self.check('ntp', None)]
+        node = healthcheck.Node(False)
+        node.cache = {'ntp': node.start - 400}
+        node.checks = checks
+        node.results['ntp'] = (healthcheck.Future(), None)
+        node.save_cache()
+        with open(healthcheck.CACHE_FILE) as f:
+            self.assertEqual(json.load(f), {})
+
+    def test_debug_ignores_cache(self):
+        checks = [self.check('ntp', None)]
+        with open(healthcheck.CACHE_FILE, 'w') as f:
+            json.dump({'ntp': healthcheck.time.time()}, f)
+        node = healthcheck.Node(True)
+        node.run(checks)
+        node.result(checks[0])
+        node.save_cache()
+        self.assertEqual(self.ran, ['ntp'])
+
+
+class DiskCheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.node = healthcheck.Node(True)
+        self.node.mounts = [healthcheck.healthcheck_fs.Mount(device, mount_point, 'ext4', source)
+                            for device, mount_point, source in [('8:1', '/', '/dev/sda1'),
+                                                                ('8:2', '/pool', '/dev/sdb'),
+                                                                ('0:40', '/dev/shm', 'tmpfs'),
+                                                                ('252:16', '/mnt/context', '/dev/vdb')]]
+        self.probe = healthcheck.Probe(self.node, healthcheck.time.time() + 10)
+
+    def statvfs(self, spaces):
+        """
+        Mock os.statvfs, with the blocks available on each path out of 1000 4k blocks
+        """
+        def statvfs(path):
+            if spaces[path] is None:
+                raise OSError('Input/output error')
+            return mock.Mock(f_blocks=1000, f_bfree=spaces[path], f_bavail=spaces[path], f_frsize=4096)
+        return mock.patch.object(healthcheck.healthcheck_fs.os, 'statvfs', side_effect=statvfs)
+
+    def test_filesystems_ok(self):
+        with self.statvfs({'/': 50, '/pool': 500, '/mnt/context': 0}):
+            self.assertIsNone(healthcheck.check_filesystems(self.probe))
+        self.assertTrue('DEBUG: Skipping /mnt/context because we dont want it' in self.probe.output())
+
+    def test_filesystems_full(self):
+        with self.statvfs({'/': 49, '/pool': None, '/mnt/context': 0}):
+            self.assertEqual(healthcheck.check_filesystems(self.probe),
+                             ' Problem: less than 5% free on /  Problem: cannot check free space on /pool ')
+
+    def test_pool_space(self):
+        # 5000MB is 1280000 4k blocks
+        with mock.patch.object(healthcheck.healthcheck_fs.os, 'statvfs',
+                               return_value=mock.Mock(f_blocks=2000000, f_bfree=1280000, f_bavail=1280000, f_frsize=4096)):
+            self.assertIsNone(healthcheck.check_pool_space(self.probe))
+        with mock.patch.object(healthcheck.healthcheck_fs.os, 'statvfs',
+                               return_value=mock.Mock(f_blocks=2000000, f_bfree=1279999, f_bavail=1279999, f_frsize=4096)):
+            self.assertEqual(healthcheck.check_pool_space(self.probe), 'Problem: less than 5000Mb free on /pool')
+
+
+if __name__ == '__main__':
+    unittest.main()